@@ -0,0 +1,6 @@
+"""Benchmarks of Supermake's hot paths, run against generated projects (see synthetic.py).
+
+- hotpaths.py: time and memory of crawling, library lookups, CodeFilesStore lookups and makefile generation, at
+  several project sizes, kept per version in benchmarks/results/.
+- scan_memory.py: peak RSS of crawling a tree full of big generated headers.
+"""
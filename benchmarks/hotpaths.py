@@ -0,0 +1,196 @@
+"""Time and measure the memory of Supermake's hot paths on synthetic projects, to compare versions.
+
+Usage: python benchmarks/hotpaths.py [--scales=100,1000,10000,50000] [--label=NAME] [--compare=RESULTS.json]
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchmarksDirectory = os.path.dirname(os.path.abspath(__file__))
+repositoryRoot = os.path.dirname(benchmarksDirectory)
+resultsDirectory = os.path.join(benchmarksDirectory, "results")
+
+defaultScales = [100, 1000, 10000, 50000]  # Files (sources and headers) in the project
+
+
+def projectShape(fileCount):
+    """The generateProject() arguments for a project of about fileCount files."""
+    return {
+        "sourceCount": fileCount * 2 // 3,
+        "headerCount": fileCount - fileCount * 2 // 3,
+        "fanOut": 2,
+        "depth": 5,
+        "cycleCount": fileCount // 100,
+        "nesting": 4,
+        "libraryFraction": 0.2,
+    }
+
+
+def newSupermake(arguments):
+    """A Supermake with its options parsed from arguments, but not run."""
+    from supermake import main
+
+    return main.Supermake(arguments, run=False)
+
+
+def measure(function):
+    """Run function timed, and then again under tracemalloc. Returns the seconds and the peak kilobytes."""
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        function()
+        unused, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peakKilobytes": peak // 1024}
+
+
+def child(fileCount):
+    """Generate a project of fileCount files in a temporary directory and measure each hot path on it."""
+    from benchmarks.synthetic import generateProject
+    from supermake import main
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="supermake_bench_") as root:
+        generateProject(root, **projectShape(fileCount))
+        os.chdir(root)
+        arguments = ["-R", "--quiet", "--binary=bench"]
+
+        def crawlCold():
+            newSupermake(arguments + ["--no-scan-cache"])._Crawl()
+
+        results["crawl (no scan cache)"] = measure(crawlCold)
+
+        newSupermake(arguments)._Crawl()  # Fill the scan cache
+
+        def crawlWarm():
+            newSupermake(arguments)._Crawl()
+
+        results["crawl (scan cache)"] = measure(crawlWarm)
+
+        supermake = newSupermake(arguments)
+        supermake._Crawl()
+        supermake._NameBuild()
+        codeFiles = list(supermake._codeFilesStore.values()) + supermake._sourceCodeFiles
+        systemIncludes = [header for codeFile in codeFiles for header in codeFile.GetSystemIncludes()]
+
+        def getLibsCold():
+            main._libsByHeader.clear()
+            for header in systemIncludes:
+                main.getLibs(header)
+
+        def getLibsWarm():
+            for header in systemIncludes:
+                main.getLibs(header)
+
+        results["getLibs (cold)"] = measure(getLibsCold)
+        results["getLibs (memoized)"] = measure(getLibsWarm)
+
+        includePaths = [path for codeFile in codeFiles for path in codeFile.GetLocalIncludePaths()]
+
+        def storeLookups():
+            store = supermake._codeFilesStore
+            for path in includePaths:
+                if path in store:
+                    store[path]
+
+        results["CodeFilesStore lookups"] = measure(storeLookups)
+
+        supermake._GenerateBuildFile()  # Fill the flag cache, so that no backtick flag command is timed
+        results["_GenerateMakefile"] = measure(supermake._GenerateBuildFile)
+
+    results["files"] = fileCount
+    results["lookups"] = {"getLibs": len(systemIncludes), "CodeFilesStore": len(includePaths)}
+    print(json.dumps(results))
+
+
+def runScale(fileCount):
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", str(fileCount)],
+        env=dict(os.environ, PYTHONPATH=repositoryRoot),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(process.stdout.decode().splitlines()[-1])
+
+
+def defaultLabel():
+    try:
+        return (
+            subprocess.run(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=repositoryRoot,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime("%Y%m%d-%H%M%S")
+
+
+def report(results, previous=None):
+    for scale, measurements in sorted(results["scales"].items(), key=lambda item: int(item[0])):
+        print(f"{scale} files:")
+        for name, measurement in measurements.items():
+            if not isinstance(measurement, dict) or "seconds" not in measurement:
+                continue
+            line = f"  {name:<24} {measurement['seconds']:10.4f}s {measurement['peakKilobytes']:10d} KB"
+            old = (previous or {}).get("scales", {}).get(scale, {}).get(name)
+            if old and old["seconds"] > 0:
+                line += "   {:5.2f}x time, {:5.2f}x memory vs {}".format(
+                    measurement["seconds"] / old["seconds"],
+                    measurement["peakKilobytes"] / max(1, old["peakKilobytes"]),
+                    previous["label"],
+                )
+            print(line)
+
+
+def run(scales=None, label=None, compare=None):
+    label = label or defaultLabel()
+    results = {"label": label, "python": sys.version.split()[0], "time": time.time(), "scales": {}}
+    for fileCount in scales or defaultScales:
+        results["scales"][str(fileCount)] = runScale(fileCount)
+
+    previous = None
+    if compare is None:
+        others = [
+            path
+            for path in glob.glob(os.path.join(resultsDirectory, "*.json"))
+            if os.path.basename(path) != label + ".json"
+        ]
+        if others:
+            compare = max(others, key=os.path.getmtime)
+    if compare is not None:
+        with open(compare) as previousFile:
+            previous = json.load(previousFile)
+
+    os.makedirs(resultsDirectory, exist_ok=True)
+    resultsPath = os.path.join(resultsDirectory, label + ".json")
+    with open(resultsPath, "w") as resultsFile:
+        json.dump(results, resultsFile, indent=1)
+    report(results, previous)
+    print("Results written to " + resultsPath)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(int(sys.argv[2]))
+    else:
+        options = dict(argument[2:].split("=", 1) for argument in sys.argv[1:] if argument.startswith("--"))
+        run(
+            [int(scale) for scale in options["scales"].split(",")] if "scales" in options else None,
+            options.get("label"),
+            options.get("compare"),
+        )
@@ -0,0 +1,64 @@
+"""Peak memory (RSS) of Supermake crawling a large synthetic tree full of big generated headers.
+
+Usage: python benchmarks/scan_memory.py [SOURCES] [HEADERS] [HEADER_KB]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+repositoryRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generateTree(root, sourceCount, headerCount, headerKilobytes):
+    """Write sourceCount .cpp files, each including a handful of headerCount generated table headers."""
+    row = "    0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e, 0x0f,\n"
+    rows = row * max(1, headerKilobytes * 1024 // len(row))
+    for i in range(headerCount):
+        with open(os.path.join(root, f"table{i}.h"), "w") as header:
+            header.write("#pragma once\n#include <stdint.h>\n")
+            if i + 1 < headerCount:
+                header.write(f'#include "table{i + 1}.h"\n')
+            header.write(f"static const uint8_t table{i}[] = {{\n{rows}}};\n")
+    for i in range(sourceCount):
+        with open(os.path.join(root, f"source{i}.cpp"), "w") as source:
+            source.write(f'#include "table{i % headerCount}.h"\n#include <math.h>\n')
+            source.write(f"int function{i}() {{ return table{i % headerCount}[0]; }}\n")
+
+
+def measure(root):
+    """Run Supermake over root in a fresh process and return its peak RSS in kilobytes."""
+    child = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        cwd=root,
+        env=dict(os.environ, PYTHONPATH=repositoryRoot),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return int(child.stdout.decode().split()[-1])
+
+
+def child():
+    from supermake import main
+
+    sys.argv = ["supermake", "--print", "--quiet", "--no-scan-cache", "--binary=bench"]
+    sys.stdout = open(os.devnull, "w")
+    main.Supermake()
+    sys.stdout = sys.__stdout__
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def run(sourceCount=2000, headerCount=200, headerKilobytes=1024):
+    with tempfile.TemporaryDirectory(prefix="supermake_bench_") as root:
+        generateTree(root, sourceCount, headerCount, headerKilobytes)
+        peak = measure(root)
+    print(f"{sourceCount} sources, {headerCount} headers of {headerKilobytes} KB: peak RSS {peak / 1024.0:.1f} MB")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        child()
+    else:
+        run(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""Generate synthetic C/C++ projects to run Supermake against."""
+
+import os
+import random
+
+from supermake import main
+
+systemHeaders = ["vector", "string", "map", "memory", "algorithm", "stdio.h", "stdlib.h", "string.h"]
+
+
+def generateProject(
+    root, sourceCount=100, headerCount=50, fanOut=4, depth=4, cycleCount=0, nesting=0, libraryFraction=0.2, seed=0
+):
+    """Write a project of sourceCount .cpp files and headerCount headers under root, the same one every time for the
+    same arguments. Returns the paths of the files written, relative to root.
+
+    The headers are split into depth layers. Every source file #includes fanOut headers of the top layer, and every
+    header fanOut headers of the layer below it, so include chains are depth long. cycleCount headers also #include
+    one of the layer above them, which closes an include cycle. With nesting, the files are spread over directories up
+    to that deep (for -R), #including each other by relative path. libraryFraction of the files #include a header from
+    Supermake's libraries table, the rest a standard one.
+    """
+    generator = random.Random(seed)
+    libraryHeaders = sorted(main.libraries)
+
+    def directory():
+        return os.path.join(".", *[f"d{generator.randrange(4)}" for _ in range(generator.randint(0, nesting))])
+
+    layers = [[] for _ in range(max(1, min(depth, headerCount)))]
+    layerOf = {}
+    headers = []
+    for i in range(headerCount):
+        header = os.path.normpath(os.path.join(directory(), f"header{i}.h"))
+        headers.append(header)
+        layerOf[header] = i * len(layers) // headerCount
+        layers[layerOf[header]].append(header)
+    sources = [os.path.normpath(os.path.join(directory(), f"source{i}.cpp")) for i in range(sourceCount)]
+
+    lowerHeaders = [header for layer in layers[1:] for header in layer]
+    cycleHeaders = set(generator.sample(lowerHeaders, min(cycleCount, len(lowerHeaders))))
+
+    for path in headers + sources:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+
+    def write(path, includes, body):
+        with open(os.path.join(root, path), "w") as codeFile:
+            if path.endswith(".h"):
+                codeFile.write("#pragma once\n")
+            if generator.random() < libraryFraction:
+                codeFile.write(f"#include <{generator.choice(libraryHeaders)}>\n")
+            else:
+                codeFile.write(f"#include <{generator.choice(systemHeaders)}>\n")
+            for include in includes:
+                codeFile.write('#include "{}"\n'.format(os.path.relpath(include, os.path.dirname(path) or ".")))
+            codeFile.write(body)
+
+    for header in headers:
+        layer = layerOf[header]
+        includes = []
+        if layer + 1 < len(layers):
+            includes = generator.sample(layers[layer + 1], min(fanOut, len(layers[layer + 1])))
+        if header in cycleHeaders:
+            includes.append(generator.choice(layers[layer - 1]))
+        write(header, includes, "int {}();\n".format(os.path.basename(header)[: -len(".h")]))
+    for source in sources:
+        includes = generator.sample(layers[0], min(fanOut, len(layers[0]))) if headers else []
+        write(source, includes, "int {}() {{ return 0; }}\n".format(os.path.basename(source)[: -len(".cpp")]))
+
+    return headers + sources
@@ -0,0 +1,213 @@
+"""The compile cache behind --compile-cache. Imported by launcher.py for every compile, so stdlib only."""
+
+import os
+import json
+import hashlib
+import subprocess
+import tempfile
+import shutil
+
+
+class CompileCache:
+    """A cache of compiled objects, keyed by a hash of the preprocessed source, the command and the compiler."""
+
+    version = 1
+    defaultMaxSize = 5 * 1024**3
+
+    def __init__(self, directory, maxSize=None):
+        self._directory = directory
+        self._maxSize = maxSize or self.defaultMaxSize
+
+    @staticmethod
+    def GetDefaultDirectory():
+        return os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "supermake"
+        )
+
+    def Exec(self, command):
+        """Run the compile command, or restore its output from the cache. Returns the exit status."""
+        objectPath, depfilePath = self._GetOutputPaths(command)
+        key = self._Key(command) if objectPath else None
+        if key is None:
+            return subprocess.call(command)
+
+        entryPath = os.path.join(self._directory, key[:2], key)
+        if self._Restore(entryPath, objectPath, depfilePath):
+            self._Record("hit")
+            return 0
+        self._Record("miss")
+
+        returncode = subprocess.call(command)
+        if returncode == 0:
+            try:
+                self._Store(entryPath, objectPath, depfilePath)
+            except OSError as e:
+                print("Supermake: Warning: Unable to store '" + objectPath + "' in the compile cache: " + str(e))
+        return returncode
+
+    def Evict(self):
+        """Remove the least recently used entries until the cache fits in its maximum size again."""
+        entries = []
+        totalSize = 0
+        for entry in self._ListEntries():
+            entries.append(entry)
+            totalSize += entry[2]
+        entries.sort()
+        for _, entryPath, size in entries:
+            if totalSize <= self._maxSize:
+                break
+            for extension in [".o", ".d"]:  # The object first, as that is what makes it a hit
+                try:
+                    os.remove(entryPath + extension)
+                except OSError:
+                    pass
+            totalSize -= size
+        self._FoldStats()
+
+    def GetStats(self):
+        """Return the hits and misses ever recorded, and the number and total size of the entries."""
+        self._FoldStats()
+        stats = self._LoadStats()
+        entries = list(self._ListEntries())
+        stats["entries"] = len(entries)
+        stats["size"] = sum(entry[2] for entry in entries)
+        stats["maxSize"] = self._maxSize
+        return stats
+
+    @staticmethod
+    def _GetOutputPaths(command):
+        """Where command writes its object file and its depfile (or None for either)."""
+        objectPath = depfilePath = None
+        for i, argument in enumerate(command[:-1]):
+            if argument == "-o":
+                objectPath = command[i + 1]
+            elif argument == "-MF":
+                depfilePath = command[i + 1]
+        if depfilePath is None and objectPath and ("-MD" in command or "-MMD" in command):
+            depfilePath = os.path.splitext(objectPath)[0] + ".d"
+        if "-c" not in command:
+            objectPath = None  # Not a compile
+        return objectPath, depfilePath
+
+    def _Key(self, command):
+        """Hash everything that determines the output of command, or return None if that is not possible."""
+        preprocessCommand = []
+        skip = False
+        for argument in command:
+            if skip:
+                skip = False
+            elif argument in ("-o", "-MF", "-MT", "-MQ"):
+                skip = True
+            elif argument not in ("-c", "-MD", "-MMD", "-MP"):
+                preprocessCommand.append(argument)
+        compilerPath = shutil.which(command[0])
+        try:
+            preprocessed = subprocess.run(preprocessCommand + ["-E"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            compilerStat = os.stat(os.path.realpath(compilerPath)) if compilerPath else None
+        except OSError:
+            return None
+        if preprocessed.returncode != 0 or compilerStat is None:
+            return None  # Let the real compile report the problem
+
+        key = hashlib.sha256()
+        key.update(
+            json.dumps(
+                [self.version, os.path.realpath(compilerPath), compilerStat.st_size, compilerStat.st_mtime_ns, command]
+            ).encode()
+        )
+        key.update(preprocessed.stdout)
+        return key.hexdigest()
+
+    def _Restore(self, entryPath, objectPath, depfilePath):
+        """Copy the entry to where the compile would have written it. Returns whether it was a hit."""
+        try:
+            if depfilePath:
+                self._CopyAtomically(entryPath + ".d", depfilePath)
+            self._CopyAtomically(entryPath + ".o", objectPath)
+            os.utime(entryPath + ".o")  # Recently used
+        except OSError:
+            return False
+        return True
+
+    def _Store(self, entryPath, objectPath, depfilePath):
+        os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+        if depfilePath:
+            self._CopyAtomically(depfilePath, entryPath + ".d")
+        self._CopyAtomically(objectPath, entryPath + ".o")
+
+    @staticmethod
+    def _CopyAtomically(sourcePath, destinationPath):
+        tempFd, tempPath = tempfile.mkstemp(
+            dir=os.path.dirname(destinationPath) or ".", prefix="." + os.path.basename(destinationPath) + "_"
+        )
+        try:
+            with os.fdopen(tempFd, "wb") as tempFile, open(sourcePath, "rb") as sourceFile:
+                shutil.copyfileobj(sourceFile, tempFile)
+            os.replace(tempPath, destinationPath)
+        except BaseException:
+            os.remove(tempPath)
+            raise
+
+    def _ListEntries(self):
+        """Yield the last use, path (without extension) and size of every entry."""
+        try:
+            subdirectories = os.listdir(self._directory)
+        except OSError:
+            return
+        for subdirectory in subdirectories:
+            subdirectory = os.path.join(self._directory, subdirectory)
+            if not os.path.isdir(subdirectory):
+                continue
+            for filename in os.listdir(subdirectory):
+                if not filename.endswith(".o") or filename.startswith("."):
+                    continue
+                entryPath = os.path.join(subdirectory, filename[:-2])
+                try:
+                    stat = os.stat(entryPath + ".o")
+                    size = stat.st_size
+                    if os.path.exists(entryPath + ".d"):
+                        size += os.path.getsize(entryPath + ".d")
+                except OSError:
+                    continue
+                yield stat.st_mtime_ns, entryPath, size
+
+    def _Record(self, event):
+        """Count a hit or a miss, as a line appended to a log that _FoldStats() adds up later."""
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            fd = os.open(os.path.join(self._directory, "stats.log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, (event + "\n").encode())
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def _LoadStats(self):
+        try:
+            with open(os.path.join(self._directory, "stats.json")) as statsFile:
+                stats = json.load(statsFile)
+            return {"hits": int(stats["hits"]), "misses": int(stats["misses"])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {"hits": 0, "misses": 0}
+
+    def _FoldStats(self):
+        """Add the hits and misses logged since the last time to the totals."""
+        logPath = os.path.join(self._directory, "stats.log")
+        foldingPath = logPath + "." + str(os.getpid())
+        try:
+            os.replace(logPath, foldingPath)  # Compiles still running start a new log
+        except OSError:
+            return
+        stats = self._LoadStats()
+        with open(foldingPath) as logFile:
+            for line in logFile:
+                if line.strip() == "hit":
+                    stats["hits"] += 1
+                elif line.strip() == "miss":
+                    stats["misses"] += 1
+        statsFd, tempPath = tempfile.mkstemp(dir=self._directory, prefix=".stats_")
+        with os.fdopen(statsFd, "w") as statsFile:
+            json.dump(stats, statsFile)
+        os.replace(tempPath, os.path.join(self._directory, "stats.json"))
+        os.remove(foldingPath)
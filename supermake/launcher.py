@@ -0,0 +1,102 @@
+"""Runs a compile or link command for a build file generated by Supermake, or with --measure a benchmarked binary."""
+
+import os
+import sys
+import time
+import json
+
+
+def getCpuTime():
+    """The CPU time used by this process and its (finished) children, in microseconds."""
+    times = os.times()
+    return int((times.user + times.system + times.children_user + times.children_system) * 1e6)
+
+
+def execTimed(commandLogPath, name, category, run, startupCpuTime=0):
+    """Call run(), which runs a command, and log how long it took for Timings.CollectCommands()."""
+    start = time.time_ns() // 1000
+    startCpuTime = getCpuTime()
+    returncode = run()
+    command = {
+        "name": name,
+        "category": category,
+        "start": start,
+        "wall": time.time_ns() // 1000 - start,
+        "cpu": getCpuTime() - startCpuTime,
+        "launcher": startupCpuTime,
+    }
+    try:  # A single append is atomic, so parallel jobs can share the log
+        fd = os.open(commandLogPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, (json.dumps(command) + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+    return returncode
+
+
+def execCommand(wrapperArguments, command, startupCpuTime=0):
+    """Run command through the compile cache and/or timings as wrapperArguments say. Returns its exit status."""
+    wrapperOptions = dict(argument[2:].split("=", 1) for argument in wrapperArguments)
+
+    def run():
+        if "cache-exec" in wrapperOptions:
+            from compilecache import CompileCache  # Only needed for --compile-cache
+
+            return CompileCache(wrapperOptions["cache-exec"]).Exec(command)
+        if hasattr(os, "spawnvp"):
+            return os.spawnvp(os.P_WAIT, command[0], command)
+        import subprocess  # Slower to import, and only needed where there is no spawnvp()
+
+        return subprocess.call(command)
+
+    if "time-exec" in wrapperOptions:
+        return execTimed(
+            wrapperOptions["time-exec"],
+            wrapperOptions.get("time-name", command[0]),
+            wrapperOptions.get("time-category", "command"),
+            run,
+            startupCpuTime,
+        )
+    return run()
+
+
+def measureCommand(command):
+    """Run command with its output discarded. Returns its exit status, times in seconds and peak memory in KB."""
+    start = time.perf_counter()
+    pid = os.fork()  # From here rather than Supermake, as the child's peak memory counts the parent's too
+    if pid == 0:
+        try:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+            os.execvp(command[0], command)
+        except OSError as e:
+            os.write(2, ("Unable to run '" + command[0] + "': " + str(e) + "\n").encode())
+        os._exit(127)
+    _, status, usage = os.wait4(pid, 0)
+    return {
+        "status": os.waitstatus_to_exitcode(status),
+        "wall": time.perf_counter() - start,
+        "user": usage.ru_utime,
+        "sys": usage.ru_stime,
+        "maxrss": usage.ru_maxrss,
+    }
+
+
+def main():
+    startupCpuTime = getCpuTime()  # Starting the interpreter is nearly all CPU bound
+    if "--" not in sys.argv:
+        sys.stderr.write(
+            "Usage: launcher.py [--cache-exec=DIR] [--time-exec=LOG [--time-name=NAME]...] -- COMMAND...\n"
+            "       launcher.py --measure -- COMMAND...\n"
+        )
+        sys.exit(2)
+    separator = sys.argv.index("--")
+    if sys.argv[1:separator] == ["--measure"]:
+        print(json.dumps(measureCommand(sys.argv[separator + 1 :])))
+        sys.exit(0)
+    sys.exit(execCommand(sys.argv[1:separator], sys.argv[separator + 1 :], startupCpuTime))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
 import re
 import os
 import sys
+import json
+import hashlib
 import subprocess
 import tempfile
+import shutil
+import time
+import concurrent.futures
+import fnmatch
+import select
+import struct
+import ctypes
+import contextlib
+
+if __package__:
+    from .compilecache import CompileCache
+    from .launcher import getCpuTime
+else:  # Run as a script
+    from compilecache import CompileCache
+    from launcher import getCpuTime
 
 usage = """Usage: supermake [OPTION]...
 Automatically compiles and runs the  C or C++ source files in the current
@@ -18,10 +35,49 @@ Makefiles and GCC.
                   and require manually running the executable)
   --warn          Add the -Wall warning flag to the gcc compilation flags.
   --optimize      Add the -O3 optimization flag to the gcc compilation flags.
+  --lto=MODE      Also optimize across source files at link time (link time
+                  optimization), for use with --optimize. MODE is 'full' or
+                  'thin'. 'thin' links much faster with clang. gcc has no thin
+                  mode, so there 'full' optimizes the whole program as one and
+                  'thin' in parallel partitions. Static libraries are archived
+                  with gcc-ar or llvm-ar, which understand LTO objects. With
+                  --clang and no --linker, links with lld or gold if installed,
+                  as the default linker usually cannot read clang's LTO objects.
+  --linker=NAME   Link with the mold, lld or gold linker instead of the
+                  default one, which is usually much slower on large binaries.
+                  'auto' picks the fastest of them that is installed.
+  --pgo[=N]       Optimize the binary with profile guided optimization, for
+                  its hot paths. This builds an instrumented binary first, runs
+                  it N times (Default: 1) with the --args given as the training
+                  workload, and then builds it again optimized with the
+                  profile the runs recorded. The profile is reused until the
+                  code, the flags or the --args change. Implies --optimize.
+  --bench[=N]     Instead of running the binary once, benchmark it: run it N
+                  times (Default: 10) with the --args, its output discarded,
+                  and show the median, 95th percentile and standard deviation
+                  of its wall time, CPU time and peak memory, compared with the
+                  last benchmark that passed --bench-threshold (kept in
+                  .supermake/bench.json).
+  --bench-warmup=N
+                  Run the binary N times (Default: 1) before the benchmarked
+                  runs, untimed, to warm up caches.
+  --bench-threshold=PERCENT
+                  Fail (exit with an error) when the median wall time got more
+                  than PERCENT (Default: 5) slower than the last benchmark that
+                  passed. Failed benchmarks are never compared with, so
+                  benchmarking again does not make a slowdown pass.
+  --profile=PROFILER
+                  Build the binary with the flags PROFILER needs (in a build
+                  directory of its own), run it under PROFILER, and write a
+                  report of the functions it spent the most time in next to it,
+                  as BINARY.profile.txt. PROFILER is 'perf', 'gprof' or
+                  'gperftools'.
   --binary=NAME   Name the binary that the makefile generates. By default
                   Supermake will guess an acceptable binary name.
   --custom=FLAGS  Compile everything with additional custom gcc FLAGS. This can
-                  be used, for example, for specifying extra -D defines.
+                  be used, for example, for specifying extra -D defines. Linker
+                  flags among them (-L, -l, -Wl,...) are only passed when
+                  linking, so changing those does not recompile anything.
   --library=NAME  Build the project as a library instead. NAME specifies the
                   name and path of the library (Ex: ../lib/libamazing), similar
                   to --binary. This automatically creates both shared (.so) and
@@ -32,6 +88,55 @@ Makefiles and GCC.
                   Supermake.
   --discrete      Do not add the "This makefile was generated by Supermake..."
                   message at the top of the makefile.
+  --jobs=N, -jN   Let make run N compiles at once. (Default: the number of
+                  CPUs available to Supermake)
+  --load-average=LOAD, -lLOAD
+                  Do not let make start new compiles while the system load
+                  average is above LOAD.
+  --build-dir=DIR Put the object files (and a copy of the makefile) in DIR.
+                  By default every combination of build flags gets its own
+                  directory under build/, so switching between e.g. --debug
+                  and --optimize builds does not throw the other one away.
+  --generator=ninja
+                  Generate a build.ninja file and build with ninja instead of
+                  a makefile and make. (Falls back to make if ninja is not
+                  installed)
+  --depfiles      Let the compiler work out which headers each object depends
+                  on (with -MMD -MP), instead of trusting Supermake's own
+                  #include scanning, which only looks in include/ and
+                  ../include/. (Supermake still scans for libraries)
+  --pch[=FRACTION]
+                  Precompile the <system> headers that at least FRACTION of
+                  the source files include (Default: 0.5), and use that for
+                  every source file that includes all of them.
+  --unity[=N]     Compile the source files in batches of about N (Default: 8),
+                  each #included into one generated source file, so shared
+                  headers are parsed once per batch instead of once per file.
+  --unity-exclude=PATTERN
+                  Compile the source files matching PATTERN (Ex: 'src/*.c') on
+                  their own even with --unity, if they cannot be combined with
+                  others. Can be given more than once.
+  --compile-cache[=DIR]
+                  Remember compiled objects in DIR (Default:
+                  ~/.cache/supermake), keyed by their preprocessed source,
+                  flags and compiler, and reuse them instead of compiling the
+                  same thing again, even from another checkout.
+  --compile-cache-size=SIZE
+                  Remove the least recently used objects from the compile
+                  cache once it grows beyond SIZE. (Default: 5G)
+  --cache-stats   Show how well the compile cache is doing, and exit.
+  --scan-jobs[=N] Read and scan the code files for #includes using N worker
+                  processes. (Default N: the number of CPUs)
+  --no-scan-cache Do not remember the #includes of unchanged files between
+                  runs. (By default they are cached in .supermake/)
+  --timings[=FILE]
+                  Time each step of Supermake, and every compile and link, and
+                  write it all to FILE as a Chrome trace (Default:
+                  .supermake/timings.json) for chrome://tracing or
+                  https://ui.perfetto.dev. Also shows the slowest compiles.
+  --watch         Keep running after building (and running) the binary, and
+                  build it (and restart it) again every time a code file is
+                  saved. Stop with Ctrl+C.
   --args          Pass all arguments after the --args arg to the binary when
                   ran. (Ex: `supermake -args 5 4` passes '5' and '4' to the
                   binary when it is run)
@@ -107,6 +212,13 @@ libraries = {  # There are a lot of problems with the current approach, but most
     "Ogre": ["-lOgreMain"],
 }
 
+profilerFlags = {  # --profile's profiler -> the flags it needs, both when compiling and when linking
+    "perf": ["-g", "-fno-omit-frame-pointer"],
+    "gprof": ["-g", "-pg"],
+    # Linked in even though nothing calls it, as it starts profiling by itself given $CPUPROFILE
+    "gperftools": ["-g", "-fno-omit-frame-pointer", "-Wl,--no-as-needed"] + libraries["google/profiler.h"],
+}
+
 c_source_extensions = set(["c"])
 c_header_extensions = set(["h"])
 cpp_source_extensions = set(["c++", "cc", "cpp", "cxx"])
@@ -119,8 +231,15 @@ all_source_extensions = cpp_source_extensions | c_source_extensions
 all_header_extensions = cpp_header_extensions | c_header_extensions
 all_code_extensions = all_source_extensions | all_header_extensions
 
+stateDirectoryName = ".supermake"  # Where Supermake keeps its caches, next to the makefile.
+buildDirectoryMarker = ".supermake-build"  # Marks build directories, which crawling skips.
+launcherPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "launcher.py")  # Runs commands for us
+
 make_cmd = {"nt": "mingw32-make", "posix": "make"}[os.name]
+ninja_cmd = "ninja"
 forcedelete_cmd = {"nt": "del /F", "posix": "rm -f"}[os.name]
+makedirectory_cmd = {"nt": "mkdir", "posix": "mkdir -p"}[os.name]
+linkers = {"mold": "mold", "lld": "ld.lld", "gold": "ld.gold"}  # -fuse-ld name -> executable, fastest first
 executable_extension = {"nt": ".exe", "posix": ""}[os.name]
 
 
@@ -177,6 +296,92 @@ def shellEscape(string):
     # Q: Why not just use quotes? A: gmake does not like quotes.
 
 
+flagArgumentOptions = {  # Options whose argument may be given as the next word, and which variable they go in
+    "-I": "CPPFLAGS",
+    "-D": "CPPFLAGS",
+    "-U": "CPPFLAGS",
+    "-isystem": "CPPFLAGS",
+    "-iquote": "CPPFLAGS",
+    "-idirafter": "CPPFLAGS",
+    "-include": "CPPFLAGS",
+    "-L": "LDFLAGS",
+    "-Xlinker": "LDFLAGS",
+    "-l": "LDLIBS",
+    "-framework": "LDLIBS",
+}
+linkOnlyFlags = ["-rdynamic", "-shared", "-static", "-static-libgcc", "-static-libstdc++", "-pie", "-no-pie"]
+
+
+def splitFlags(flags):
+    """Sort flags into CPPFLAGS, LDFLAGS, LDLIBS and CFLAGS (the rest, passed both when compiling and linking).
+
+    >>> flags = splitFlags("-Iinclude -O3 -L lib -lSDL -Wl,-rpath,lib -D NDEBUG `foo-config --libs` -pthread")
+    >>> flags["CPPFLAGS"], flags["CFLAGS"]
+    ('-Iinclude -D NDEBUG', '-O3 `foo-config --libs` -pthread')
+    >>> flags["LDFLAGS"], flags["LDLIBS"]
+    ('-L lib -Wl,-rpath,lib', '-lSDL')
+
+    Options taking a separate argument keep it, and libraries can be given as files or frameworks as well:
+
+    >>> flags = splitFlags("-framework Cocoa -l m -isystem /opt/x -UNDEBUG -Xlinker --as-needed libfoo.a -std=c11")
+    >>> flags["CPPFLAGS"], flags["CFLAGS"]
+    ('-isystem /opt/x -UNDEBUG', '-std=c11')
+    >>> flags["LDFLAGS"], flags["LDLIBS"]
+    ('-Xlinker --as-needed', '-framework Cocoa -l m libfoo.a')
+    >>> splitFlags("-shared -fuse-ld=gold -fopenmp")["LDFLAGS"]
+    '-shared -fuse-ld=gold'
+    """
+    variables = {"CPPFLAGS": [], "CFLAGS": [], "LDFLAGS": [], "LDLIBS": []}
+    words = re.findall(r"`[^`]*`|\S+", flags)
+    i = 0
+    while i < len(words):
+        word = words[i]
+        variable = "CFLAGS"
+        if word in flagArgumentOptions:
+            variable = flagArgumentOptions[word]
+            if i + 1 < len(words):
+                i += 1
+                word += " " + words[i]
+        elif word.startswith(("-I", "-D", "-U")):
+            variable = "CPPFLAGS"
+        elif word.startswith(("-L", "-Wl,", "-fuse-ld=")) or word in linkOnlyFlags:
+            variable = "LDFLAGS"
+        elif word.startswith("-l") or (not word.startswith("-") and re.search(r"\.(?:a|so|dylib|lib)$", word)):
+            variable = "LDLIBS"
+        variables[variable].append(word)
+        i += 1
+    return {variable: " ".join(words) for variable, words in variables.items()}
+
+
+def availableCpuCount():
+    """The number of CPUs Supermake may actually use, respecting the CPU affinity mask and cgroup CPU quotas."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+
+    for quotaPath, periodPath in [
+        ("/sys/fs/cgroup/cpu.max", None),  # cgroup v2
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),  # cgroup v1
+    ]:
+        try:
+            if periodPath is None:
+                quota, period = open(quotaPath).read().split()[:2]
+            else:
+                quota, period = open(quotaPath).read().strip(), open(periodPath).read().strip()
+            if quota not in ("max", "-1"):
+                count = min(count, max(1, -(-int(quota) // int(period))))
+            break
+        except (OSError, ValueError):
+            continue
+
+    return count
+
+
+def ninjaEscape(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+
 def fileExtension(basename):  # Similar to os.path.basename
     try:
         return basename[basename.rindex(".") + 1 :]
@@ -191,23 +396,609 @@ def fileName(basename):  # Similar to os.path.dirname
         return False
 
 
+_libraryPrefixTrie = (
+    None  # libraries, compiled by getLibs() into nested dicts keyed by character. The None key holds the flags.
+)
+_libsByHeader = {}
+
+
 def getLibs(header):
-    libs = set([])
+    """Return the library flags needed for #including header: those of every libraries entry that is a prefix of it.
+
+    >>> sorted(getLibs("SDL/SDL_image.h"))
+    ['-lSDL_image', '`sdl-config --cflags --libs`']
+    >>> getLibs("vector")
+    frozenset()
+    """
+    global _libraryPrefixTrie
+    libs = _libsByHeader.get(header)
+    if libs is not None:
+        return libs
+
+    if _libraryPrefixTrie is None:
+        _libraryPrefixTrie = {}
+        for headerpart, library in libraries.items():
+            node = _libraryPrefixTrie
+            for character in headerpart:
+                node = node.setdefault(character, {})
+            node[None] = library
+
+    libs = set(_libraryPrefixTrie.get(None, []))
+    node = _libraryPrefixTrie
+    for character in header:
+        node = node.get(character)
+        if node is None:
+            break
+        if None in node:
+            libs.update(node[None])
+
+    libs = frozenset(libs)
+    _libsByHeader[header] = libs
+    return libs
 
-    if header in libraries:
-        libs.update(libraries[header])
 
-    for headerpart, library in libraries.items():
-        if header.startswith(headerpart):
-            libs.update(library)
+# Macros whose state is already known on the platform Supermake runs on, used when evaluating #ifs while scanning. (None
+# means known to be undefined.)
+platformDefines = {
+    "posix": {"_WIN32": None, "_WIN64": None, "_MSC_VER": None, "__MINGW32__": None},
+    "nt": {"_WIN32": "1", "__unix__": None, "unix": None, "__linux__": None, "__APPLE__": None},
+}[os.name]
+if sys.platform.startswith(("linux", "cygwin", "freebsd", "openbsd", "netbsd", "dragonfly")):
+    platformDefines.update({"__unix__": "1", "unix": "1"})
+if sys.platform.startswith("linux"):
+    platformDefines.update({"__linux__": "1", "linux": "1", "__APPLE__": None, "__MACH__": None})
+elif sys.platform == "darwin":  # Which is posix, but does not define __unix__
+    platformDefines.update({"__APPLE__": "1", "__MACH__": "1", "__unix__": None, "unix": None, "__linux__": None})
+
+directivePattern = re.compile(r"#\s*([a-z]+)\s*(.*?)\s*$", re.DOTALL)
+systemIncludePattern = re.compile(r"<(.+?)>")
+localIncludePattern = re.compile(r'"(.+?)"')
+identifierPattern = re.compile(r"[A-Za-z_]\w*")
+conditionTokenPattern = re.compile(
+    r"\s*(0[xX][0-9a-fA-F]+[uUlL]*|\d+[uUlL]*|[A-Za-z_]\w*|&&|\|\||==|!=|<=|>=|<<|>>|\S)"
+)
+
+
+class ConditionEvaluator:
+    """Evaluates simple #if expressions. Whatever it cannot be sure of evaluates to None, meaning 'unknown'.
+
+    >>> evaluator = ConditionEvaluator({"VERSION": "3", "NDEBUG": None})
+    >>> evaluator.Evaluate("VERSION >= 2 && !defined(NDEBUG)"), evaluator.Evaluate("defined NDEBUG || VERSION == 4")
+    (True, False)
+    >>> evaluator.Evaluate("(1 << 4) + 1 == 0x11")
+    True
+    >>> evaluator.Evaluate("UNKNOWN > 1"), evaluator.Evaluate("UNKNOWN || VERSION"), evaluator.Evaluate("UNKNOWN && 0")
+    (None, True, False)
+    """
+
+    def __init__(self, defines):
+        self._defines = defines
+
+    def Evaluate(self, expression):
+        """Return True, False, or None if the outcome of the expression cannot be known without really preprocessing."""
+        value = self.EvaluateValue(expression)
+        if value is None:
+            return None
+        return value != 0
+
+    def EvaluateValue(self, expression, depth=0):
+        """Return the integer value of the expression, or None if it is unknown."""
+        self._tokens = [
+            re.sub(r"[uUlL]+$", "", token) if token[0].isdigit() else token
+            for token in conditionTokenPattern.findall(expression)
+        ]
+        self._position = 0
+        self._depth = depth
+        try:
+            value = self._Or()
+        except (IndexError, ValueError, ZeroDivisionError):
+            return None
+        if self._position != len(self._tokens):
+            return None
+        return value
+
+    def _Peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _Next(self):
+        self._position += 1
+        return self._tokens[self._position - 1]
+
+    def _Or(self):
+        value = self._And()
+        while self._Peek() == "||":
+            self._Next()
+            other = self._And()
+            if value or other:  # Either side known true
+                value = 1
+            elif value is None or other is None:
+                value = None
+            else:
+                value = 0
+        return value
+
+    def _And(self):
+        value = self._Binary(0)
+        while self._Peek() == "&&":
+            self._Next()
+            other = self._Binary(0)
+            if value == 0 or other == 0:
+                value = 0
+            elif value is None or other is None:
+                value = None
+            else:
+                value = 1
+        return value
+
+    _binaryOperators = [
+        {"==": lambda a, b: int(a == b), "!=": lambda a, b: int(a != b)},
+        {
+            "<": lambda a, b: int(a < b),
+            ">": lambda a, b: int(a > b),
+            "<=": lambda a, b: int(a <= b),
+            ">=": lambda a, b: int(a >= b),
+        },
+        {"<<": lambda a, b: a << b, ">>": lambda a, b: a >> b},
+        {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+        {"*": lambda a, b: a * b, "/": lambda a, b: int(a / b), "%": lambda a, b: a % b},
+    ]
+
+    def _Binary(self, level):
+        if level == len(self._binaryOperators):
+            return self._Unary()
+        value = self._Binary(level + 1)
+        while self._Peek() in self._binaryOperators[level]:
+            operator = self._binaryOperators[level][self._Next()]
+            other = self._Binary(level + 1)
+            value = None if value is None or other is None else operator(value, other)
+        return value
+
+    def _Unary(self):
+        token = self._Next()
+        if token == "!":
+            value = self._Unary()
+            return None if value is None else int(not value)
+        if token == "-":
+            value = self._Unary()
+            return None if value is None else -value
+        if token == "+":
+            return self._Unary()
+        if token == "(":
+            value = self._Or()
+            if self._Next() != ")":
+                raise ValueError()
+            return value
+        if token == "defined":
+            name = self._Next()
+            if name == "(":
+                name = self._Next()
+                if self._Next() != ")":
+                    raise ValueError()
+            if name not in self._defines:
+                return None
+            return int(self._defines[name] is not None)
+        if token[0].isdigit():
+            return int(token, 0)
+        if identifierPattern.fullmatch(token):
+            if self._Peek() == "(":  # Function-like macro, don't even try.
+                nesting = 0
+                while True:
+                    nextToken = self._Next()
+                    nesting += {"(": 1, ")": -1}.get(nextToken, 0)
+                    if nesting == 0:
+                        return None
+            if token not in self._defines:
+                return None
+            if self._defines[token] is None:
+                return 0  # Undefined identifiers are 0 in #if
+            if self._depth > 8:
+                return None
+            return ConditionEvaluator(self._defines).EvaluateValue(self._defines[token] or "1", self._depth + 1)
+        raise ValueError()
+
+
+def stripComments(line):
+    """Remove the comments from a line of code. Returns it and whether a /* comment is still open at its end."""
+    code = []
+    start = 0
+    quote = None
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if quote:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c == '"' or c == "'":
+            quote = c
+        elif c == "/" and line.startswith("//", i):
+            code.append(line[start:i])
+            return "".join(code) + "\n", False
+        elif c == "/" and line.startswith("/*", i):
+            code.append(line[start:i] + " ")
+            end = line.find("*/", i + 2)
+            if end == -1:
+                return "".join(code) + "\n", True
+            i = start = end + 2
+            continue
+        i += 1
+    code.append(line[start:])
+    return "".join(code), False
+
+
+def scanCodeFile(filepath, defines=None):
+    """Pick out what a code file #includes, skipping comments and #if blocks that defines certainly disable.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), "scan.c")
+    >>> with open(path, "w") as codeFile:
+    ...     _ = codeFile.write('''#include "a.h" // #include "line_comment.h"
+    ... /* #include "block_comment.h"
+    ... #include "block_comment2.h" */ #include "b.h"
+    ... #if 0
+    ... #include "disabled.h"
+    ... #elif defined(FEATURE) && VERSION > 2
+    ... #include "feature.h"
+    ... #elif UNKNOWN
+    ... #include "unknown.h"
+    ... #else
+    ... #include "fallback.h"
+    ... #endif
+    ... #define LEVEL 2
+    ... #if LEVEL > 1 || defined FEATURE
+    ... #include "level.h"
+    ... #elif 1
+    ... #include "level_taken.h"
+    ... #endif
+    ... #ifndef _WIN32
+    ... #include <pthread.h>
+    ... #endif
+    ... ''')
+    >>> scan = scanCodeFile(path, {"FEATURE": None, "VERSION": "3", "_WIN32": None})
+    >>> scan["local"], scan["system"], scan["libraries"], scan["directiveBeforeInclude"], scan["systemAfterLocal"]
+    (['a.h', 'b.h', 'unknown.h', 'fallback.h', 'level.h'], ['pthread.h'], ['-pthread'], True, ['pthread.h'])
+    >>> shutil.rmtree(os.path.dirname(path))
+    """
+    defines = dict(defines or {})
+    evaluator = ConditionEvaluator(defines)
+    conditionals = []  # [live, certain, taken] of each open #if. taken: whether an earlier branch was certainly true
+    live = True
+    certain = True  # Whether every enclosing branch is certainly taken.
+    inComment = False
+
+    systemHeaders = []
+    localHeaders = []
+    libraryDependencies = set([])
+    otherDirective = False  # Whether a directive other than #include was seen yet
+    directiveBeforeInclude = False
+    systemAfterLocal = []
+
+    with open(filepath) as codeFile:
+        for line in codeFile:
+            if inComment:
+                end = line.find("*/")
+                if end == -1:
+                    continue
+                line = line[end + 2 :]
+                inComment = False
+            if "/" in line:
+                line, inComment = stripComments(line)
+            line = line.lstrip()
+            if not line.startswith("#"):
+                continue
+            while line.endswith("\\\n") and not inComment:
+                continuation, inComment = stripComments(next(codeFile, ""))
+                line = line[:-2] + " " + continuation
 
-    return libs
+            m = directivePattern.match(line)
+            if not m:
+                continue
+            directive, argument = m.groups()
+            if directive != "include":
+                otherDirective = True
+            elif otherDirective:
+                directiveBeforeInclude = True
+
+            if directive in ("if", "ifdef", "ifndef"):
+                if directive == "if":
+                    condition = evaluator.Evaluate(argument)
+                else:
+                    name = argument.split()[0] if argument.split() else ""
+                    condition = None if name not in defines else defines[name] is not None
+                    if directive == "ifndef" and condition is not None:
+                        condition = not condition
+                conditionals.append([live, certain, condition is True])
+                live = live and condition is not False
+                certain = certain and condition is True
+            elif directive in ("elif", "else") and conditionals:
+                parentLive, parentCertain, taken = conditionals[-1]
+                condition = True if directive == "else" else evaluator.Evaluate(argument)
+                live = parentLive and not taken and condition is not False
+                certain = parentCertain and not taken and condition is True
+                conditionals[-1][2] = taken or condition is True
+            elif directive == "endif" and conditionals:
+                live, certain, unused = conditionals.pop()
+            elif not live:
+                continue
+            elif directive in ("define", "undef"):
+                m = identifierPattern.match(argument)
+                if m:
+                    name = m.group()
+                    if not certain:
+                        defines.pop(name, None)  # Might or might not happen, so unknown from here on.
+                    elif directive == "undef":
+                        defines[name] = None
+                    elif argument[m.end() : m.end() + 1] == "(":
+                        defines.pop(name, None)  # Function-like macro, can't evaluate it.
+                    else:
+                        defines[name] = argument[m.end() :].strip()
+            elif directive == "include":
+                m = systemIncludePattern.match(argument)
+                if m:
+                    systemHeaders.append(m.group(1))
+                    libraryDependencies.update(getLibs(m.group(1)))
+                    if localHeaders:
+                        systemAfterLocal.append(m.group(1))
+                    continue
+                m = localIncludePattern.match(argument)
+                if m:
+                    headerDeps = getLibs(m.group(1))
+                    if (
+                        headerDeps
+                    ):  # Why doesn't python respect the assignment operator as a real operator with a return value?
+                        libraryDependencies.update(headerDeps)
+                    else:
+                        localHeaders.append(m.group(1))
+
+    return {
+        "system": systemHeaders,
+        "local": localHeaders,
+        "libraries": sorted(libraryDependencies),
+        "directiveBeforeInclude": directiveBeforeInclude,
+        "systemAfterLocal": systemAfterLocal,
+    }
+
+
+def resolveLocalHeader(directory, header, missingPaths=None):
+    """Find the file a quoted #include in directory refers to, or None. Paths tried in vain go to missingPaths."""
+    header = os.path.relpath(os.path.join(directory, header))
+    for candidate in [header, os.path.join("include", header), os.path.join("..", "include", header)]:  # hacky
+        if os.path.exists(candidate):
+            return candidate
+        if missingPaths is not None:
+            missingPaths.append(os.path.normpath(candidate))
+    return None  # otherwise it is like #include "stdlib.h"
+
+
+def loadState(path):
+    """Read one of Supermake's JSON state files (a cache, the manifest...). Returns None if it is missing or corrupt."""
+    try:
+        with open(path) as stateFile:
+            state = json.load(stateFile)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+
+def saveState(path, state, description):
+    """Write state to the JSON state file path, atomically. Returns whether it was written."""
+    try:
+        stateFd, tempPath = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", prefix="." + os.path.basename(path) + "_"
+        )
+        with os.fdopen(stateFd, "w") as stateFile:
+            json.dump(state, stateFile)
+        os.replace(tempPath, path)
+    except OSError as e:
+        logger.WarningMessage("Unable to write the " + description + " '" + path + "': " + str(e))
+        return False
+    return True
+
+
+def fingerprintFile(path):
+    """The size and modification time of the file at path, or None if there is none."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ScanCache:
+    """Remembers the scanCodeFile() results between runs, so that unchanged files are never read again."""
+
+    version = 4
+    # Files modified this recently may change again without their mtime changing, so they are also fingerprinted by
+    # content.
+    racyInterval = 2  # seconds
+
+    def __init__(self, path, defines=None):
+        self._path = path
+        self._defines = defines
+        self._entries = {}
+        self._usedEntries = {}
+        self._dirty = False
+        self._signature = (
+            str(self.version)
+            + ":"
+            + hashlib.sha1(json.dumps([libraries, defines], sort_keys=True).encode()).hexdigest()
+        )
+
+    def Load(self):
+        """Load the cache from disk. A missing, corrupt, or out of date cache is simply ignored."""
+        cache = loadState(self._path) or {}
+        if cache.get("signature") == self._signature and isinstance(cache.get("entries"), dict):
+            self._entries = cache["entries"]
+
+    def Save(self):
+        """Write the cache back to disk, keeping only the entries used during this run."""
+        if not self._dirty and len(self._usedEntries) == len(self._entries):
+            return
+        if saveState(self._path, {"signature": self._signature, "entries": self._usedEntries}, "scan cache"):
+            self._entries = dict(self._usedEntries)
+            self._dirty = False
+
+    def Scan(self, filepath):
+        """Return scanCodeFile(filepath), reading the file only if it has changed since it was last scanned."""
+        stat = os.stat(filepath)
+        scan = self.Lookup(filepath, stat)
+        if scan is None:
+            scan = scanCodeFile(filepath, self._defines)
+            self.Store(filepath, stat, scan)
+        return scan
+
+    def Lookup(self, filepath, stat):
+        """Return the cached scan of filepath, or None if it changed. stat must be taken before reading it."""
+        entry = self._entries.get(filepath)
+        if entry is not None and self._IsFresh(entry, filepath, stat):
+            if "sha1" in entry and time.time() - stat.st_mtime >= self.racyInterval:
+                entry = {key: value for key, value in entry.items() if key != "sha1"}  # No longer racy
+                self._entries[filepath] = entry
+                self._dirty = True
+            self._usedEntries[filepath] = entry
+            return entry["scan"]
+        return None
+
+    def Store(self, filepath, stat, scan):
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "scan": scan}
+        if time.time() - stat.st_mtime < self.racyInterval:
+            entry["sha1"] = self._HashFile(filepath)
+        self._usedEntries[filepath] = entry
+        self._dirty = True
+
+    def _IsFresh(self, entry, filepath, stat):
+        try:
+            if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                return False
+            if "sha1" in entry:
+                return entry["sha1"] == self._HashFile(filepath)
+            return isinstance(entry["scan"], dict)
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _HashFile(filepath):
+        with open(filepath, "rb") as codeFile:
+            return hashlib.sha1(codeFile.read()).hexdigest()
+
+
+class FlagCache:
+    """Expands the `command` flags of the libraries table once, and remembers them until their inputs change."""
+
+    version = 1
+    environmentVariables = ["PATH", "PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR", "PKG_CONFIG_SYSROOT_DIR"]
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._usedEntries = {}
+        self._failedEntries = {}  # Not saved, see above
+        self._dirty = False
+
+    def Load(self):
+        cache = loadState(self._path) or {}
+        if cache.get("version") == self.version and isinstance(cache.get("entries"), dict):
+            self._entries = cache["entries"]
+
+    def Save(self):
+        if not self._dirty and len(self._usedEntries) == len(self._entries):
+            return
+        saveState(self._path, {"version": self.version, "entries": self._usedEntries}, "flag cache")
+
+    def Expand(self, flag):
+        """Return flag with a `command` replaced by its escaped output, or as it is if the command fails."""
+        if not (flag.startswith("`") and flag.endswith("`") and len(flag) > 1):
+            return flag
+        command = flag[1:-1]
+        failedEntry = self._failedEntries.get(command)
+        if failedEntry is not None and self._IsFresh(failedEntry):
+            return flag
+        entry = self._entries.get(command)
+        if entry is None or not self._IsFresh(entry):
+            entry = {
+                "environment": self.GetEnvironment(),
+                "inputs": {path: fingerprintFile(path) for path in self._FindInputs(command)},
+            }
+            try:
+                result = subprocess.run(command, shell=True, capture_output=True)
+                error = result.stderr.decode(errors="replace").strip() if result.returncode != 0 else None
+            except OSError as e:
+                error = str(e)
+            if error is not None:
+                logger.WarningMessage("'" + command + "' failed, leaving it for the compiler: " + error)
+                self._failedEntries[command] = entry
+                return flag
+            entry["flags"] = " ".join(result.stdout.decode().split())
+            self._entries[command] = entry
+            self._dirty = True
+        self._usedEntries[command] = entry
+        return self._Escape(entry["flags"])
+
+    def GetInputs(self):
+        """The files and directories the expanded flags were derived from."""
+        return sorted(set(path for entry in self._usedEntries.values() for path in entry["inputs"]))
+
+    @staticmethod
+    def _Escape(flags):
+        """Escape a command's output for the build file, where make (or ninja) and then the shell go over it.
+
+        >>> print(FlagCache._Escape("-I/usr/include/x -Wl,-rpath,$ORIGIN/../lib -DNAME=\\"x\\""))
+        -I/usr/include/x -Wl,-rpath,\\$$ORIGIN/../lib -DNAME=\\"x\\"
+        """
+        return re.sub(r"""([\\"'`$;&|<>()])""", r"\\\1", flags).replace("$", "$$")
+
+    def _IsFresh(self, entry):
+        try:
+            return entry["environment"] == self.GetEnvironment() and all(
+                fingerprintFile(path) == fingerprint for path, fingerprint in entry["inputs"].items()
+            )
+        except (KeyError, TypeError, AttributeError):
+            return False
+
+    @classmethod
+    def GetEnvironment(cls):
+        """The environment variables the expanded flags may depend on."""
+        return {name: os.environ.get(name) for name in cls.environmentVariables}
+
+    @staticmethod
+    def _FindInputs(command):
+        """The files (and directories) that command's output depends on, as far as can be told."""
+        words = command.split()
+        executable = shutil.which(words[0]) if words else None
+        if executable is None:
+            return []
+        inputs = [os.path.realpath(executable)]
+        if os.path.basename(words[0]) == "pkg-config":
+            searchPath = os.environ.get("PKG_CONFIG_PATH", "").split(os.pathsep)
+            try:
+                searchPath += (
+                    subprocess.run(
+                        [executable, "--variable", "pc_path", "pkg-config"],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                    )
+                    .stdout.decode()
+                    .strip()
+                    .split(os.pathsep)
+                )
+            except OSError:
+                pass
+            packages = [word for word in words[1:] if not word.startswith("-")]
+            for directory in searchPath:
+                if not directory:
+                    continue
+                inputs.append(directory)  # Its mtime changes when .pc files are added, removed or replaced
+                for package in packages:
+                    pcFile = os.path.join(directory, package + ".pc")
+                    if os.path.exists(pcFile):
+                        inputs.append(pcFile)
+        return inputs
 
 
 class CodeFile:
 
     def __init__(self, filepath, codeFilesStore):
-        """Check to make sure it is really code, and then build dependency tree, recursively invoking numerous other files along the way"""
+        """Check to make sure it is really code, and then find which libraries and local files it #includes."""
         self._directory, basename = os.path.split(os.path.normpath(os.path.relpath(filepath)))
         self._name = fileName(basename)
         self._extension = fileExtension(basename)
@@ -217,49 +1008,20 @@ class CodeFile:
         if self._extension not in all_code_extensions and os.path.isfile(self.GetFullPath()):
             raise NotCodeError()
 
-        self._codeFilesStore = codeFilesStore
-
-        self._libraryDependencies = set([])
-        self._codeFileDependencies = set([])
-
-        self._content = open(self.GetFullPath()).read()
-
-        m = re.findall(
-            r"^#include <(.+?)>", self._content, re.MULTILINE
-        )  # Warning, if #includes are commented out using C comments(/* */), they will still be considered included.  I don't know how to avoid this short of implementing a pre-processor. use cpp maybe?
-        for header in m:
-            self._libraryDependencies.update(getLibs(header))
-        m = re.findall(r'^#include "(.+?)"', self._content, re.MULTILINE)
-        for header in m:
-            headerDeps = getLibs(header)
-            if headerDeps:  # Why doesn't python respect the assignment operator as a real operator with a return value?
-                self._libraryDependencies.update(headerDeps)
-            else:  # Check for local inclusion
-                header = os.path.relpath(os.path.join(self._directory, header))
-                if os.path.exists(header):
-                    header = header
-                elif os.path.exists(os.path.join("include", header)):  # hacky
-                    header = os.path.join("include", header)
-                elif os.path.exists(os.path.join("..", "include", header)):
-                    header = os.path.join("..", "include", header)
-                else:  # otherwise it is like #include "stdlib.h"
-                    continue
-
-                try:
-                    includeCodeFile = None
-                    if header in self._codeFilesStore:
-                        includeCodeFile = self._codeFilesStore[header]
-                    else:
-                        includeCodeFile = CodeFile(header, self._codeFilesStore)
-                        self._codeFilesStore.add(includeCodeFile)
-
-                    self._codeFileDependencies.add(includeCodeFile)
-                    self._codeFileDependencies.update(includeCodeFile.GetCodeFileDependencies())
-                    self._libraryDependencies.update(includeCodeFile.GetLibraryDependencies())
-
-                except NotCodeError:
-                    # logger.WarningMessage('Found unknown included file \''+header+'\'.')
-                    pass
+        self._libraryDependencies = set([])  # Only those from this file's own #includes, see GetLibraryDependencies()
+        self._localIncludePaths = []
+        self._missingIncludePaths = []
+        self._includeGraph = None
+
+        scan = codeFilesStore.Scan(self.GetFullPath())
+        self._libraryDependencies.update(scan["libraries"])
+        self._systemIncludes = scan["system"]
+        self._directiveBeforeInclude = scan["directiveBeforeInclude"]
+        self._systemIncludesAfterLocal = scan["systemAfterLocal"]
+        for header in scan["local"]:
+            header = resolveLocalHeader(self._directory, header, self._missingIncludePaths)
+            if header is not None:
+                self._localIncludePaths.append(header)
 
     def GetLanguage(self):
         """Return the language of the code in this CodeFile, either C or C++."""
@@ -270,11 +1032,40 @@ class CodeFile:
         else:
             return "unknown"
 
-    def GetLibraryDependencies(self):
+    def GetDirectLibraryDependencies(self):
+        """Return the libraries needed by this file's own #includes."""
         return self._libraryDependencies
 
+    def GetLocalIncludePaths(self):
+        """Return the paths of the local files this file directly #includes."""
+        return self._localIncludePaths
+
+    def GetMissingIncludePaths(self):
+        """Return the paths this file's quoted #includes were looked for at in vain."""
+        return self._missingIncludePaths
+
+    def GetSystemIncludes(self):
+        """Return the <system> headers this file directly #includes."""
+        return self._systemIncludes
+
+    def HasDirectiveBeforeInclude(self):
+        """Return whether a directive other than #include comes before one of this file's own #includes."""
+        return self._directiveBeforeInclude
+
+    def GetSystemIncludesAfterLocal(self):
+        """Return the <system> headers this file directly #includes after one of its local headers."""
+        return self._systemIncludesAfterLocal
+
+    def SetIncludeGraph(self, includeGraph):
+        self._includeGraph = includeGraph
+
+    def GetLibraryDependencies(self):
+        """Return the libraries needed by this file and everything it includes."""
+        return self._includeGraph.GetLibraryDependencies(self)
+
     def GetCodeFileDependencies(self):
-        return self._codeFileDependencies
+        """Return every CodeFile this file includes, directly or indirectly."""
+        return self._includeGraph.GetCodeFileDependencies(self)
 
     def GetFullPath(self):
         return self._fullPath
@@ -286,27 +1077,663 @@ class CodeFile:
         return self._directory
 
     def GetContent(self):
-        return self._content
+        """Read the whole file. The content is not kept around, as only a few heuristics need it."""
+        with open(self.GetFullPath()) as codeFile:
+            return codeFile.read()
 
     def __str__(self):
         return "Codefile: " + self.GetFullPath()
 
 
-class CodeFilesStore(
-    set
-):  # more expensive than it should be. Todo: Separation of path from the codeFile and store the path as a dict key? class Path {str dir; str name; str extension; str fullPath;}
+class CodeFilesStore(dict):
+    """All of the CodeFiles found so far, indexed by their full path."""
+
+    def __init__(self, scanCache=None, defines=None):
+        super().__init__()
+        self._scanCache = scanCache
+        self._defines = defines
+        self._prescanned = {}
+
+    def add(self, codeFile):
+        self[codeFile.GetFullPath()] = codeFile
+
+    def Forget(self, filepaths):
+        """Drop everything known about filepaths, so they are scanned again the next time they are needed."""
+        for filepath in filepaths:
+            self.pop(filepath, None)
+            self._prescanned.pop(filepath, None)
+
+    def Scan(self, filepath):
+        """scanCodeFile(), going through PrescanAll()'s results and the ScanCache if there is one."""
+        if filepath in self._prescanned:
+            return self._prescanned[filepath]
+        if self._scanCache is not None:
+            return self._scanCache.Scan(filepath)
+        return scanCodeFile(filepath, self._defines)
+
+    def PrescanAll(self, filepaths, jobs):
+        """Scan filepaths and every local header they lead to with jobs worker processes."""
+        seen = set([])
+        pending = {}
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+
+            def visit(filepath):
+                filepath = os.path.normpath(os.path.relpath(filepath))
+                if filepath in seen:
+                    return
+                seen.add(filepath)
+                if fileExtension(os.path.basename(filepath)) not in all_code_extensions:
+                    return
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    return
+                scan = None
+                if self._scanCache is not None:
+                    scan = self._scanCache.Lookup(filepath, stat)
+                if scan is None:
+                    pending[executor.submit(scanCodeFile, filepath, self._defines)] = (filepath, stat)
+                else:
+                    visitIncludes(filepath, scan)
+
+            def visitIncludes(filepath, scan):
+                self._prescanned[filepath] = scan
+                for header in scan["local"]:
+                    header = resolveLocalHeader(os.path.dirname(filepath), header)
+                    if header is not None:
+                        visit(header)
+
+            for filepath in filepaths:
+                visit(filepath)
+
+            while pending:
+                done, unused = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    filepath, stat = pending.pop(future)
+                    try:
+                        scan = future.result()
+                    except Exception:
+                        continue
+                    if self._scanCache is not None:
+                        self._scanCache.Store(filepath, stat, scan)
+                    visitIncludes(filepath, scan)
+
+
+class CompileUnit:
+    """One object file to compile: its source file, every file it depends on, and flags only it gets."""
+
+    def __init__(self, objectFileName, sourcePath, dependencyPaths, flags=""):
+        self._objectFileName = objectFileName
+        self._sourcePath = sourcePath
+        self._dependencyPaths = dependencyPaths
+        self._flags = flags
+
+    def GetObjectFileName(self):
+        return self._objectFileName
+
+    def GetSourcePath(self):
+        return self._sourcePath
+
+    def GetDependencyPaths(self):
+        return self._dependencyPaths
+
+    def GetFlags(self):
+        return self._flags
+
+
+class IncludeGraph:
+    """Which CodeFiles include which, and the transitive header and library dependencies of each of them.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> headers = {"a.h": ["b.h"], "b.h": ["a.h", "c.h"], "c.h": ["c.h"], "d.h": ["e1.h", "e2.h"], "e1.h": ["f.h"],
+    ...            "e2.h": ["f.h"], "f.h": ["<pthread.h>"]}
+    >>> for name, includes in headers.items():
+    ...     with open(os.path.join(directory, name), "w") as header:
+    ...         _ = header.write("".join("#include " + (i if i[0] == "<" else '"' + i + '"') + "\\n" for i in includes))
+    >>> store = CodeFilesStore()
+    >>> roots = [CodeFile(os.path.join(directory, name), store) for name in ["a.h", "d.h"]]
+    >>> graph = IncludeGraph(roots, store)
+    >>> codeFiles = {codeFile.GetName(): codeFile for codeFile in roots + list(store.values())}
+    >>> for name in sorted(codeFiles):
+    ...     dependencies = sorted(dependency.GetName() for dependency in codeFiles[name].GetCodeFileDependencies())
+    ...     print(name, dependencies, sorted(codeFiles[name].GetLibraryDependencies()))
+    a ['b', 'c'] []
+    b ['a', 'c'] []
+    c [] []
+    d ['e1', 'e2', 'f'] ['-pthread']
+    e1 ['f'] ['-pthread']
+    e2 ['f'] ['-pthread']
+    f [] ['-pthread']
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, codeFiles, codeFilesStore):
+        """Load every local file codeFiles (transitively) include into codeFilesStore, and solve the closures."""
+        self._codeFiles = []  # id -> CodeFile
+        self._ids = {}  # CodeFile -> id
+        self._edges = []  # id -> [id]
+        self._libraries = []  # library id -> flag
+        self._libraryIds = {}  # flag -> library id
+        self._componentOf = []  # id -> component
+        self._componentDependencies = []  # component -> bitset of file ids
+        self._componentLibraryDependencies = []  # component -> bitset of library ids
+
+        self._Load(codeFiles, codeFilesStore)
+        self._Solve()
+
+        for codeFile in self._codeFiles:
+            codeFile.SetIncludeGraph(self)
+
+    def GetCodeFileDependencies(self, codeFile):
+        fileId = self._ids[codeFile]
+        return set(
+            self._Decode(self._componentDependencies[self._componentOf[fileId]] & ~(1 << fileId), self._codeFiles)
+        )
+
+    def GetLibraryDependencies(self, codeFile):
+        return set(
+            self._Decode(self._componentLibraryDependencies[self._componentOf[self._ids[codeFile]]], self._libraries)
+        )
+
+    def _Intern(self, codeFile):
+        fileId = self._ids.get(codeFile)
+        if fileId is None:
+            fileId = len(self._codeFiles)
+            self._ids[codeFile] = fileId
+            self._codeFiles.append(codeFile)
+            self._edges.append(None)
+        return fileId
+
+    def _Load(self, codeFiles, codeFilesStore):
+        toVisit = [self._Intern(codeFile) for codeFile in codeFiles]
+        while toVisit:
+            fileId = toVisit.pop()
+            if self._edges[fileId] is not None:
+                continue
+            edges = []
+            for header in self._codeFiles[fileId].GetLocalIncludePaths():
+                if header in codeFilesStore:
+                    includeCodeFile = codeFilesStore[header]
+                else:
+                    try:
+                        includeCodeFile = CodeFile(header, codeFilesStore)
+                    except NotCodeError:
+                        # logger.WarningMessage('Found unknown included file \''+header+'\'.')
+                        continue
+                    codeFilesStore.add(includeCodeFile)
+                includeId = self._Intern(includeCodeFile)
+                edges.append(includeId)
+                if self._edges[includeId] is None:
+                    toVisit.append(includeId)
+            self._edges[fileId] = edges
+
+    def _Solve(self):
+        """Find the strongly connected components (iterative Tarjan), and solve their closures dependencies-first."""
+        fileCount = len(self._codeFiles)
+        index = [None] * fileCount
+        lowLink = [0] * fileCount
+        onStack = [False] * fileCount
+        stack = []
+        self._componentOf = [None] * fileCount
+        counter = 0
+
+        for root in range(fileCount):
+            if index[root] is not None:
+                continue
+            index[root] = lowLink[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack[root] = True
+            work = [(root, iter(self._edges[root]))]
+            while work:
+                fileId, children = work[-1]
+                for child in children:
+                    if index[child] is None:
+                        index[child] = lowLink[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        onStack[child] = True
+                        work.append((child, iter(self._edges[child])))
+                        break
+                    elif onStack[child]:
+                        lowLink[fileId] = min(lowLink[fileId], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parentId = work[-1][0]
+                        lowLink[parentId] = min(lowLink[parentId], lowLink[fileId])
+                    if lowLink[fileId] == index[fileId]:
+                        members = []
+                        while True:
+                            member = stack.pop()
+                            onStack[member] = False
+                            members.append(member)
+                            if member == fileId:
+                                break
+                        self._SolveComponent(members)
+
+    def _SolveComponent(self, members):
+        component = len(self._componentDependencies)
+        for member in members:
+            self._componentOf[member] = component
+
+        dependencies = 0
+        libraryDependencies = 0
+        for member in members:
+            for library in self._codeFiles[member].GetDirectLibraryDependencies():
+                libraryId = self._libraryIds.get(library)
+                if libraryId is None:
+                    libraryId = len(self._libraries)
+                    self._libraryIds[library] = libraryId
+                    self._libraries.append(library)
+                libraryDependencies |= 1 << libraryId
+            for includeId in self._edges[member]:
+                dependencies |= 1 << includeId
+                includeComponent = self._componentOf[includeId]
+                if includeComponent != component:
+                    dependencies |= self._componentDependencies[includeComponent]
+                    libraryDependencies |= self._componentLibraryDependencies[includeComponent]
+
+        self._componentDependencies.append(dependencies)
+        self._componentLibraryDependencies.append(libraryDependencies)
+
+    @staticmethod
+    def _Decode(bitset, items):
+        """The items whose ids are set in bitset. Only visits the set bits, as the closures are usually sparse.
+
+        >>> IncludeGraph._Decode(0b100101, "abcdef")
+        ['a', 'c', 'f']
+        """
+        bits = bin(bitset)[:1:-1]  # Lowest bit first
+        decoded = []
+        i = bits.find("1")
+        while i != -1:
+            decoded.append(items[i])
+            i = bits.find("1", i + 1)
+        return decoded
+
+
+libraryFilePattern = re.compile(r"lib([^\.]+)\.(?:so|a)")
+
+
+class BuildManifest:
+    """A fingerprint of everything the generated makefile was derived from, to skip crawling while it holds."""
+
+    version = 2
+
+    def __init__(self, path, arguments):
+        self._path = path
+        if "--args" in arguments:  # Those only matter when running
+            arguments = arguments[: arguments.index("--args")]
+        self._arguments = arguments
+        self._manifest = None
+
+    def IsUpToDate(self):
+        manifest = loadState(self._path)
+        if manifest is None:
+            return False
+        try:
+            if (
+                manifest["version"] != self.version
+                or manifest["arguments"] != self._arguments
+                or manifest["cwd"] != os.path.realpath(".")
+                or manifest["environment"] != FlagCache.GetEnvironment()
+            ):
+                return False
+            for path, fingerprint in manifest["files"].items():
+                if fingerprintFile(path) != fingerprint:
+                    return False
+            for path, fingerprint in manifest["directories"].items():
+                if self._FingerprintDirectory(path) != fingerprint:
+                    return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        self._manifest = manifest
+        return True
+
+    def GetBuildName(self):
+        return self._manifest["buildName"]
+
+    def Save(self, buildName, files, generatedFiles, directories):
+        """Record the fingerprints, unless files were modified too recently for their stat to be trusted."""
+        manifest = {
+            "version": self.version,
+            "arguments": self._arguments,
+            "cwd": os.path.realpath("."),
+            "environment": FlagCache.GetEnvironment(),
+            "buildName": buildName,
+            "files": {path: fingerprintFile(path) for path in sorted(set(files) | set(generatedFiles))},
+            "directories": {path: self._FingerprintDirectory(path) for path in sorted(set(directories))},
+        }
+        now = time.time_ns()
+        if any(
+            manifest["files"][path] and now - manifest["files"][path][1] < ScanCache.racyInterval * 10**9
+            for path in files
+        ):
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.WarningMessage("Unable to remove the build manifest '" + self._path + "': " + str(e))
+            return
+        saveState(self._path, manifest, "build manifest")
+
+    @staticmethod
+    def _FingerprintDirectory(path):
+        """Hash the names of the code files, libraries and subdirectories in the directory."""
+        try:
+            with os.scandir(path) as entries:
+                names = sorted(
+                    entry.name + "/" if entry.is_dir() else entry.name
+                    for entry in entries
+                    if entry.is_dir()
+                    or fileExtension(entry.name) in all_code_extensions
+                    or libraryFilePattern.match(entry.name)
+                )
+        except OSError:
+            return None
+        return hashlib.sha1("\n".join(names).encode()).hexdigest()
+
+
+class Timings:
+    """Records how long each phase and each compile and link took, and writes it out as a Chrome trace."""
+
+    slowestCount = 10  # How many of the slowest compiles to report
+
+    def __init__(self, tracePath, commandLogPath):
+        self._tracePath = tracePath
+        self._commandLogPath = commandLogPath
+        self._phases = []  # [name, start, wall time, cpu time], in microseconds
+        self._commands = []  # Likewise, plus the category and the launcher's startup cpu time
+        self._reportedPhaseCount = 0
+        self._reportedCommandCount = 0
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        start = time.time_ns() // 1000
+        startCpuTime = getCpuTime()
+        try:
+            yield
+        finally:
+            self._phases.append([name, start, time.time_ns() // 1000 - start, getCpuTime() - startCpuTime])
+
+    def DiscardCommands(self):
+        """Forget the compiles and links logged so far without collecting them."""
+        try:
+            os.remove(self._commandLogPath)
+        except OSError:
+            pass
+
+    def CollectCommands(self):
+        """Pick up the compiles and links logged since the last time."""
+        collectingPath = self._commandLogPath + "." + str(os.getpid())
+        try:
+            os.replace(self._commandLogPath, collectingPath)
+        except OSError:
+            return
+        with open(collectingPath) as logFile:
+            for line in logFile:
+                try:
+                    command = json.loads(line)
+                    self._commands.append(
+                        [
+                            command["name"],
+                            command["start"],
+                            command["wall"],
+                            command["cpu"],
+                            command["category"],
+                            command.get("launcher", 0),
+                        ]
+                    )
+                except (ValueError, KeyError, TypeError):
+                    continue
+        os.remove(collectingPath)
+
+    def Save(self):
+        """Write the trace. Overlapping commands (from parallel jobs) are spread over as many rows as needed."""
+        events = [
+            {
+                "name": name,
+                "cat": "supermake",
+                "ph": "X",
+                "ts": start,
+                "dur": wall,
+                "pid": 1,
+                "tid": 0,
+                "args": {"cpu_us": cpu},
+            }
+            for name, start, wall, cpu in self._phases
+        ]
+        rowEnds = []  # row -> when its last command ends
+        for name, start, wall, cpu, category, _launcher in sorted(self._commands, key=lambda command: command[1]):
+            row = next((row for row, rowEnd in enumerate(rowEnds) if rowEnd <= start), len(rowEnds))
+            if row == len(rowEnds):
+                rowEnds.append(0)
+            rowEnds[row] = start + wall
+            events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start,
+                    "dur": wall,
+                    "pid": 1,
+                    "tid": row + 1,
+                    "args": {"cpu_us": cpu},
+                }
+            )
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "supermake"}})
+        for row in range(len(rowEnds)):
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": row + 1, "args": {"name": "job " + str(row + 1)}}
+            )
+        try:
+            with open(self._tracePath, "w") as traceFile:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, traceFile)
+        except OSError as e:
+            logger.WarningMessage("Unable to write the timings to '" + self._tracePath + "': " + str(e))
+
+    def Report(self):
+        """Print the time taken by each phase, and the slowest compiles, since the last Report()."""
+        logger.NoticeMessage(
+            "Timings written to '" + self._tracePath + "' (open it in chrome://tracing or https://ui.perfetto.dev)"
+        )
+        phases = self._phases[self._reportedPhaseCount :]
+        commands = self._commands[self._reportedCommandCount :]
+        self._reportedPhaseCount = len(self._phases)
+        self._reportedCommandCount = len(self._commands)
+        for name, _start, wall, cpu in phases:
+            logger.Message(f"  {name:<12} {wall / 1e6:8.3f}s wall {cpu / 1e6:8.3f}s cpu")
+        compiles = sorted((command for command in commands if command[4] == "compile"), key=lambda command: -command[2])
+        if compiles:
+            logger.Message("  Slowest compiles:")
+            for name, _start, wall, cpu, _category, _launcher in compiles[: self.slowestCount]:
+                logger.Message(f"  {wall / 1e6:8.3f}s wall {cpu / 1e6:8.3f}s cpu  {name}")
+        if commands:
+            # Starting the launcher every compile and link runs through is not included in their times
+            launcherCpuTime = sum(command[5] for command in commands)
+            logger.Message(
+                f"  Launcher startup: {launcherCpuTime / 1e6:.3f}s cpu over {len(commands)} commands"
+                f" ({launcherCpuTime / len(commands) / 1e3:.1f}ms each)"
+            )
 
-    def __contains__(self, path):
-        for codeFile in self:
-            if codeFile.GetFullPath() == path:
-                return True
-        return False
 
-    def __getitem__(self, path):
-        for codeFile in self:
-            if codeFile.GetFullPath() == path:
-                return codeFile
-        raise KeyError()
+def summarize(values):
+    """The median, 95th percentile (nearest rank) and standard deviation of values.
+
+    >>> summarize([4.0, 1.0, 3.0, 2.0])
+    {'median': 2.5, 'p95': 4.0, 'stddev': 1.118033988749895}
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    median = values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+    p95 = values[max(0, -(-len(values) * 95 // 100) - 1)]
+    mean = sum(values) / len(values)
+    stddev = (sum((value - mean) ** 2 for value in values) / len(values)) ** 0.5
+    return {"median": median, "p95": p95, "stddev": stddev}
+
+
+class Benchmark:
+    """Times runs of the built binary, and compares them with the history of the last builds that did not regress."""
+
+    metrics = [("wall", "s"), ("user", "s"), ("sys", "s"), ("maxrss", "KB")]
+    historyLength = 100  # Entries kept per binary and arguments
+
+    def __init__(self, historyPath, threshold):
+        self._historyPath = historyPath
+        self._threshold = threshold
+
+    @staticmethod
+    def Measure(argv, cwd=None):
+        """Run argv through launcher.py, output discarded. Returns its times in seconds and peak memory in KB."""
+        if not hasattr(os, "fork"):
+            raise SupermakeError("--bench is not supported on this platform.")
+        try:
+            result = subprocess.run(
+                [sys.executable, "-S", launcherPath, "--measure", "--"] + argv, cwd=cwd, stdout=subprocess.PIPE
+            )
+            sample = json.loads(result.stdout)
+        except (OSError, ValueError) as e:
+            raise SupermakeError("Unable to run '" + argv[0] + "': " + str(e)) from e
+        if sample["status"] != 0:
+            raise SupermakeError("The benchmarked binary exited with status " + str(sample["status"]) + ".")
+        return {metric: sample[metric] for metric, unit in Benchmark.metrics}
+
+    def Record(self, key, samples):
+        """Add the summary of samples to the history under key. Returns how many percent slower it is, or None."""
+        summary = {metric: summarize([sample[metric] for sample in samples]) for metric, unit in self.metrics}
+        history = loadState(self._historyPath) or {}
+        entries = history.setdefault(key, [])
+        baseline = next((entry["summary"] for entry in reversed(entries) if not entry.get("regressed")), None)
+
+        logger.Message("Benchmark of " + str(len(samples)) + " runs:")
+        logger.Message("  {:<8} {:>12} {:>12} {:>12}".format("", "median", "p95", "stddev"))
+        for metric, unit in self.metrics:
+            line = "  {:<8} {:>12} {:>12} {:>12}".format(
+                metric, *[self._Format(summary[metric][statistic], unit) for statistic in ["median", "p95", "stddev"]]
+            )
+            if baseline and baseline[metric]["median"] > 0:
+                line += "  {:+.1f}% vs the baseline".format(
+                    (summary[metric]["median"] / baseline[metric]["median"] - 1) * 100
+                )
+            logger.Message(line)
+
+        slowdown = None
+        if baseline and baseline["wall"]["median"] > 0:
+            slowdown = (summary["wall"]["median"] / baseline["wall"]["median"] - 1) * 100
+        regressed = slowdown is not None and slowdown > self._threshold
+        entries.append({"time": time.time(), "runs": len(samples), "summary": summary, "regressed": regressed})
+        del entries[: -self.historyLength]
+        saveState(self._historyPath, history, "benchmark history")
+        return slowdown
+
+    @staticmethod
+    def _Format(value, unit):
+        if unit == "s":
+            return f"{value:.4f}s"
+        return f"{value:.0f}{unit}"
+
+
+class FileWatcher:
+    """Waits for code files in a set of directories to change, through inotify or else by polling."""
+
+    inotifyMask = 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+    inotifyIsDirectory = 0x40000000  # IN_ISDIR
+    pollInterval = 0.5  # seconds
+    debounceInterval = 0.1  # seconds. How long it must stay quiet before the changes so far are reported.
+
+    def __init__(self, directories):
+        self._libc = None
+        self._inotifyFd = -1
+        self._watches = {}  # watch descriptor -> directory
+        self._directories = set([])
+        self._snapshot = {}
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._inotifyFd = libc.inotify_init1(os.O_CLOEXEC)
+            if self._inotifyFd >= 0:
+                self._libc = libc
+        except (OSError, AttributeError):  # Not Linux
+            pass
+        self.SetDirectories(directories)
+
+    def SetDirectories(self, directories):
+        """Watch exactly directories (not recursively) from now on."""
+        directories = set(os.path.normpath(directory) for directory in directories)
+        if self._libc is not None:
+            for watch, directory in list(self._watches.items()):
+                if directory not in directories:
+                    self._libc.inotify_rm_watch(self._inotifyFd, watch)
+                    del self._watches[watch]
+            for directory in directories - self._directories:
+                watch = self._libc.inotify_add_watch(self._inotifyFd, os.fsencode(directory), self.inotifyMask)
+                if watch >= 0:
+                    self._watches[watch] = directory
+        self._directories = directories
+        self._snapshot = self._Snapshot()
+
+    def Wait(self):
+        """Block until code files change, and then until they stop changing. Returns the changed paths."""
+        changedPaths = set([])
+        while not changedPaths:
+            changedPaths.update(self._Read(None))
+        while True:
+            morePaths = self._Read(self.debounceInterval)
+            if not morePaths:
+                return changedPaths
+            changedPaths.update(morePaths)
+
+    def Close(self):
+        if self._libc is not None:
+            os.close(self._inotifyFd)
+            self._libc = None
+
+    def _Read(self, timeout):
+        """Return the code files and directories that changed within timeout seconds (or ever, with None)."""
+        if self._libc is None:
+            time.sleep(self.pollInterval if timeout is None else max(timeout, self.pollInterval))
+            snapshot = self._Snapshot()
+            changedPaths = set(
+                path for path in set(snapshot) | set(self._snapshot) if snapshot.get(path) != self._snapshot.get(path)
+            )
+            self._snapshot = snapshot
+            return changedPaths
+
+        readable, unused, unused = select.select([self._inotifyFd], [], [], timeout)
+        if not readable:
+            return set([])
+        events = os.read(self._inotifyFd, 65536)
+        changedPaths = set([])
+        offset = 0
+        while offset < len(events):
+            watch, mask, cookie, nameLength = struct.unpack_from("iIII", events, offset)
+            name = os.fsdecode(events[offset + 16 : offset + 16 + nameLength].rstrip(b"\0"))
+            offset += 16 + nameLength
+            if watch in self._watches and (
+                mask & self.inotifyIsDirectory or fileExtension(name) in all_code_extensions
+            ):
+                changedPaths.add(os.path.normpath(os.path.join(self._watches[watch], name)))
+        return changedPaths
+
+    def _Snapshot(self):
+        """The stats of every code file (and the subdirectories) in the watched directories, for polling."""
+        if self._libc is not None:
+            return {}
+        snapshot = {}
+        for directory in self._directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            snapshot[os.path.normpath(entry.path)] = None
+                        elif fileExtension(entry.name) in all_code_extensions:
+                            stat = entry.stat()
+                            snapshot[os.path.normpath(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return snapshot
 
 
 class Options:
@@ -331,6 +1758,28 @@ class Options:
         self.quiet = False
         self.discrete = False
         self.binaryArgs = []
+        self.scanCache = True
+        self.scanJobs = 1
+        self.jobs = None  # Automatic
+        self.buildDirectory = ""  # Automatic
+        self.loadAverage = None
+        self.generator = "make"
+        self.depfiles = False
+        self.precompiledHeaderFraction = None  # Disabled
+        self.unityBatchSize = 0  # Disabled
+        self.unityExcludePatterns = []
+        self.compileCacheDirectory = ""  # Disabled
+        self.compileCacheSize = None  # Default
+        self.cacheStats = False
+        self.watch = False
+        self.timingsPath = ""  # Disabled
+        self.linker = ""  # The compiler's default
+        self.lto = ""  # Disabled
+        self.pgoRuns = 0  # Disabled
+        self.benchRuns = 0  # Disabled
+        self.benchWarmupRuns = 1
+        self.benchThreshold = 5.0  # Percent
+        self.profiler = ""  # Disabled
 
         if cliArguments != None:
             self.ParseArguments(cliArguments)
@@ -342,6 +1791,30 @@ class Options:
         if self.libraryName and self.binaryName:
             raise OptionsError("Both --library and --binary specified.")
 
+        if self.benchRuns:
+            for option, conflicting in [("--library", self.libraryName), ("--watch", self.watch)]:
+                if conflicting:
+                    raise OptionsError("--bench can not be used with " + option + ".")
+
+        if self.profiler:
+            for option, conflicting in [
+                ("--library", self.libraryName),
+                ("--debug", self.debug),
+                ("--watch", self.watch),
+                ("--bench", self.benchRuns),
+            ]:
+                if conflicting:
+                    raise OptionsError("--profile can not be used with " + option + ".")
+
+        if self.pgoRuns:
+            for option, conflicting in [
+                ("--library", self.libraryName),
+                ("--debug", self.debug),
+                ("--watch", self.watch),
+            ]:
+                if conflicting:
+                    raise OptionsError("--pgo can not be used with " + option + ".")
+
     def ParseArguments(self, arguments):
         if "--args" in arguments:
             self.binaryArgs = arguments[arguments.index("--args") + 1 :]
@@ -437,13 +1910,195 @@ class Options:
                 self.discrete = True
                 continue
 
+            if argument.startswith("--jobs=") or (argument.startswith("-j") and argument != "-j"):
+                try:
+                    self.jobs = int(argument[argument.find("=") + 1 :] if "=" in argument else argument[2:])
+                except ValueError:
+                    raise OptionsError("--jobs expects a number, not: '" + argument + "'") from None
+                if self.jobs < 1:
+                    raise OptionsError("--jobs must be at least 1.")
+                continue
+
+            if argument in ("--jobs", "-j"):
+                self.jobs = None
+                continue
+
+            if argument.startswith("--load-average=") or (argument.startswith("-l") and len(argument) > 2):
+                try:
+                    self.loadAverage = float(argument[argument.find("=") + 1 :] if "=" in argument else argument[2:])
+                except ValueError:
+                    raise OptionsError("--load-average expects a number, not: '" + argument + "'") from None
+                continue
+
+            if argument == "--scan-jobs" or argument.startswith("--scan-jobs="):
+                self.scanJobs = availableCpuCount()
+                if "=" in argument:
+                    try:
+                        self.scanJobs = int(argument[argument.find("=") + 1 :])
+                    except ValueError:
+                        raise OptionsError("--scan-jobs expects a number, not: '" + argument + "'") from None
+                    if self.scanJobs < 1:
+                        raise OptionsError("--scan-jobs must be at least 1.")
+                continue
+
+            if argument.startswith("--build-dir="):
+                self.buildDirectory = argument[argument.find("=") + 1 :]
+                continue
+
+            if argument == "--no-scan-cache":
+                self.scanCache = False
+                continue
+
+            if argument == "--pch" or argument.startswith("--pch="):
+                self.precompiledHeaderFraction = 0.5
+                if "=" in argument:
+                    try:
+                        self.precompiledHeaderFraction = float(argument[argument.find("=") + 1 :])
+                    except ValueError:
+                        raise OptionsError("--pch expects a fraction, not: '" + argument + "'") from None
+                    if not 0 < self.precompiledHeaderFraction <= 1:
+                        raise OptionsError("--pch expects a fraction between 0 and 1.")
+                continue
+
+            if argument == "--unity" or argument.startswith("--unity="):
+                self.unityBatchSize = 8
+                if "=" in argument:
+                    try:
+                        self.unityBatchSize = int(argument[argument.find("=") + 1 :])
+                    except ValueError:
+                        raise OptionsError("--unity expects a number, not: '" + argument + "'") from None
+                    if self.unityBatchSize < 1:
+                        raise OptionsError("--unity must be at least 1.")
+                continue
+
+            if argument.startswith("--unity-exclude="):
+                self.unityExcludePatterns.append(argument[argument.find("=") + 1 :])
+                continue
+
+            if argument == "--compile-cache" or argument.startswith("--compile-cache="):
+                self.compileCacheDirectory = CompileCache.GetDefaultDirectory()
+                if "=" in argument:
+                    self.compileCacheDirectory = os.path.expanduser(argument[argument.find("=") + 1 :])
+                continue
+
+            if argument.startswith("--compile-cache-size="):
+                size = argument[argument.find("=") + 1 :].upper().rstrip("B")
+                multiplier = 1
+                if size and size[-1] in "KMGT":
+                    multiplier = 1024 ** ("KMGT".index(size[-1]) + 1)
+                    size = size[:-1]
+                try:
+                    self.compileCacheSize = int(float(size) * multiplier)
+                except ValueError:
+                    raise OptionsError(
+                        "--compile-cache-size expects a size like 500M or 5G, not: '" + argument + "'"
+                    ) from None
+                if self.compileCacheSize < 1:
+                    raise OptionsError("--compile-cache-size must be positive.")
+                continue
+
+            if argument == "--cache-stats":
+                self.cacheStats = True
+                continue
+
+            if argument == "--timings" or argument.startswith("--timings="):
+                self.timingsPath = os.path.join(stateDirectoryName, "timings.json")
+                if "=" in argument:
+                    self.timingsPath = argument[argument.find("=") + 1 :]
+                continue
+
+            if argument == "--watch":
+                self.watch = True
+                continue
+
+            if argument == "--depfiles":
+                self.depfiles = True
+                continue
+
+            if argument.startswith("--linker="):
+                self.linker = argument[argument.find("=") + 1 :]
+                if self.linker not in linkers and self.linker != "auto":
+                    raise OptionsError(
+                        "--linker expects 'auto', "
+                        + ", ".join("'" + linker + "'" for linker in linkers)
+                        + ", not: '"
+                        + self.linker
+                        + "'"
+                    )
+                continue
+
+            if argument == "--pgo" or argument.startswith("--pgo="):
+                self.pgoRuns = 1
+                self.optimize = True
+                if "=" in argument:
+                    try:
+                        self.pgoRuns = int(argument[argument.find("=") + 1 :])
+                    except ValueError:
+                        raise OptionsError("--pgo expects a number of training runs, not: '" + argument + "'") from None
+                    if self.pgoRuns < 1:
+                        raise OptionsError("--pgo expects at least 1 training run.")
+                continue
+
+            if argument == "--bench" or argument.startswith("--bench="):
+                self.benchRuns = 10
+                if "=" in argument:
+                    try:
+                        self.benchRuns = int(argument[argument.find("=") + 1 :])
+                    except ValueError:
+                        raise OptionsError("--bench expects a number of runs, not: '" + argument + "'") from None
+                    if self.benchRuns < 1:
+                        raise OptionsError("--bench expects at least 1 run.")
+                continue
+
+            if argument.startswith("--bench-warmup="):
+                try:
+                    self.benchWarmupRuns = int(argument[argument.find("=") + 1 :])
+                except ValueError:
+                    raise OptionsError("--bench-warmup expects a number of runs, not: '" + argument + "'") from None
+                if self.benchWarmupRuns < 0:
+                    raise OptionsError("--bench-warmup can not be negative.")
+                continue
+
+            if argument.startswith("--bench-threshold="):
+                try:
+                    self.benchThreshold = float(argument[argument.find("=") + 1 :].rstrip("%"))
+                except ValueError:
+                    raise OptionsError("--bench-threshold expects a percentage, not: '" + argument + "'") from None
+                continue
+
+            if argument.startswith("--profile="):
+                self.profiler = argument[argument.find("=") + 1 :]
+                if self.profiler not in profilerFlags:
+                    raise OptionsError(
+                        "--profile expects "
+                        + ", ".join("'" + profiler + "'" for profiler in profilerFlags)
+                        + ", not: '"
+                        + self.profiler
+                        + "'"
+                    )
+                continue
+
+            if argument.startswith("--lto="):
+                self.lto = argument[argument.find("=") + 1 :]
+                if self.lto not in ("full", "thin"):
+                    raise OptionsError("--lto expects 'full' or 'thin', not: '" + self.lto + "'")
+                continue
+
+            if argument.startswith("--generator="):
+                self.generator = argument[argument.find("=") + 1 :]
+                if self.generator not in ("make", "ninja"):
+                    raise OptionsError("--generator expects 'make' or 'ninja', not: '" + self.generator + "'")
+                continue
+
             raise OptionsError("Unrecognized argument: '" + argument + "' (For help, see --help)")
 
 
 class Supermake:
 
-    def __init__(self):
-        arguments = sys.argv[1:]
+    def __init__(self, arguments=None, run=True):
+        """Parse arguments (by default the command line's) and do everything they ask for, unless run is False."""
+        if arguments is None:
+            arguments = sys.argv[1:]
         if helpArguments & set(arguments):
             print(usage)
             sys.exit(0)
@@ -453,10 +2108,326 @@ class Supermake:
             global logger
             logger.SetQuiet()
 
-        # Crawl
-        self._Crawl()
+        if self._options.generator == "ninja" and not shutil.which(ninja_cmd):
+            logger.WarningMessage("ninja is not installed, generating a makefile instead.")
+            self._options.generator = "make"
+
+        self._profileStage = "optimized" if self._options.pgoRuns else None  # See _BuildWithProfile()
+
+        self._timings = None
+        if self._options.timingsPath and not self._options.printMakefile:
+            self._timings = Timings(self._options.timingsPath, self._GetTimingsLogPath())
+
+        self._manifest = None
+        self._writtenBuildFile = None
+        self._flagCache = None
+
+        if run:
+            self._Execute(arguments)
+
+    def _Execute(self, arguments):
+        if self._options.cacheStats:
+            self._PrintCacheStats()
+            return
+
+        # Skip straight to compiling if nothing the makefile depends on has changed since the last run
+        if not self._options.printMakefile:
+            self._manifest = BuildManifest(os.path.join(self._GetStateDirectory(), "manifest.json"), arguments)
+        with self._Phase("manifest"):
+            upToDate = (
+                self._manifest is not None
+                and not self._options.watch
+                and not self._options.pgoRuns  # Which needs the crawl to tell whether its profile is still good
+                and self._manifest.IsUpToDate()
+            )
+        if upToDate:
+            self._buildName = self._manifest.GetBuildName()
+        else:
+            # Crawl
+            with self._Phase("crawl"):
+                self._Crawl()
+
+            # Name binary
+            self._NameBuild()
 
-        # Name binary
+            # Create the makefile (or ninja file)
+            with self._Phase("generate"):
+                buildFile = self._GenerateBuildFile()
+
+            # Print the makefile
+            if self._options.printMakefile:
+                print(buildFile)
+                return
+
+            with self._Phase("write"):
+                self._WriteBuildFiles(buildFile)
+
+        if self._options.watch:
+            self._Watch()
+            return
+
+        # Compile
+        if self._options.pgoRuns:
+            compilationSuccesful = self._BuildWithProfile()
+        else:
+            compilationSuccesful = self._Build()
+
+        # Run
+        if self._options.benchRuns:
+            if not compilationSuccesful:
+                raise SupermakeError("Compilation failed.")
+            with self._Phase("bench"):
+                self._Benchmark()
+            if self._timings is not None:
+                self._timings.Save()
+        elif self._options.run:
+            if not compilationSuccesful:
+                raise SupermakeError("Compilation failed.")
+            with self._Phase("run"):
+                if self._options.profiler:
+                    self._Profile()
+                else:
+                    self._Run()
+            if self._timings is not None:
+                self._timings.Save()
+
+        if not compilationSuccesful:
+            sys.exit(1)
+
+    def _GenerateBuildFile(self):
+        """Generate the text of the makefile, or of the ninja file with --generator=ninja."""
+        self._DescribeBuild()
+        self._flagStamps = {}
+        if self._options.generator == "ninja":
+            return self._GenerateNinjafile()
+        return self._GenerateMakefile()
+
+    def _WriteBuildFiles(self, buildFile):
+        """Write out the generated makefile (or ninja file) and the files it builds from, and the manifest."""
+        self._WritePrecompiledHeader()
+        self._WriteUnityFiles()
+
+        if buildFile != self._writtenBuildFile:
+            self._writtenBuildFile = buildFile
+            self._makefile = buildFile
+            autoCleanNeeded = False
+            if self._options.generator == "ninja":
+                self._WriteNinjafile()
+            else:
+                autoCleanNeeded = self._WriteMakefile()
+                self._WriteFlagStamps()
+
+            # Autoclean
+            if autoCleanNeeded:
+                with self._Phase("autoclean"):
+                    self._Autoclean()
+
+        self._manifest.Save(self._buildName, *self._GetManifestPaths())
+
+    def _Build(self):
+        """Run make (or ninja). Returns whether it succeeded."""
+        if not self._options.make:
+            return False
+        if self._timings is not None:
+            self._timings.DiscardCommands()  # Whatever an interrupted build left behind
+        with self._Phase("build"):
+            compilationSuccesful = self._Compile()
+        if self._options.compileCacheDirectory:
+            CompileCache(self._options.compileCacheDirectory, self._options.compileCacheSize).Evict()
+        if self._timings is not None:
+            self._timings.CollectCommands()
+            self._timings.Save()
+            self._timings.Report()
+        return compilationSuccesful
+
+    def _BuildWithProfile(self):
+        """Build the instrumented binary, train it and build the optimized one. Returns whether it succeeded."""
+        if not self._options.make:
+            return False
+        profileStatePath = os.path.join(self._GetBuildDirectory("instrumented"), "profile.json")
+        fingerprint = self._GetProfileFingerprint()
+        upToDate = (loadState(profileStatePath) or {}).get("fingerprint") == fingerprint
+
+        if not upToDate:
+            self._profileStage = "instrumented"
+            self._WriteBuildFiles(self._GenerateBuildFile())
+            if not self._Build():
+                return False
+            with self._Phase("train"):
+                self._TrainProfile()
+            saveState(profileStatePath, {"fingerprint": fingerprint}, "profile state")
+
+        self._profileStage = "optimized"
+        self._WriteBuildFiles(self._GenerateBuildFile())
+        return self._Build()
+
+    def _TrainProfile(self):
+        """Run the instrumented binary --pgo's N times, and put its profile where the optimized build reads it."""
+        instrumentedDirectory = self._GetBuildDirectory("instrumented")
+        if self._options.clang:
+            rawProfileDirectory = self._GetRawProfileDirectory()
+            if os.path.isdir(rawProfileDirectory):
+                shutil.rmtree(rawProfileDirectory)
+        else:  # gcc adds up the counts of every run, so those of previous trainings have to go
+            for path in self._ListProfileFiles(instrumentedDirectory):
+                os.remove(os.path.join(instrumentedDirectory, path))
+
+        binaryParentFolder, cmdargs = self._GetRunCommand()
+        for run in range(self._options.pgoRuns):
+            logger.NoticeMessage("Training run " + str(run + 1) + " of " + str(self._options.pgoRuns) + ".")
+            status = subprocess.call(" ".join(cmdargs), shell=True, cwd=binaryParentFolder or None)
+            if status != 0:
+                logger.WarningMessage(
+                    "The training run exited with status " + str(status) + ", so its profile may be incomplete."
+                )
+
+        if self._options.clang:
+            if not shutil.which("llvm-profdata"):
+                raise SupermakeError("--pgo with --clang needs llvm-profdata to merge the training runs' profiles.")
+            rawProfiles = []
+            if os.path.isdir(rawProfileDirectory):
+                rawProfiles = [
+                    os.path.join(rawProfileDirectory, path)
+                    for path in sorted(os.listdir(rawProfileDirectory))
+                    if path.endswith(".profraw")
+                ]
+            if not rawProfiles:
+                raise SupermakeError(
+                    "The training runs did not write any profile to '"
+                    + rawProfileDirectory
+                    + "'. (Did the binary exit through exit() or by returning from main()?)"
+                )
+            if (
+                subprocess.call(["llvm-profdata", "merge", "-output=" + self._GetMergedProfilePath()] + rawProfiles)
+                != 0
+            ):
+                raise SupermakeError("Unable to merge the training runs' profiles.")
+        else:  # gcc looks for each object's profile next to it
+            optimizedDirectory = self._GetBuildDirectory("optimized")
+            for path in self._ListProfileFiles(instrumentedDirectory):
+                os.makedirs(os.path.dirname(os.path.join(optimizedDirectory, path)), exist_ok=True)
+                shutil.copyfile(os.path.join(instrumentedDirectory, path), os.path.join(optimizedDirectory, path))
+
+    @staticmethod
+    def _ListProfileFiles(directory):
+        """The paths of the .gcda profiles in directory, relative to it."""
+        profilePaths = []
+        for parentDirectory, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith(".gcda"):
+                    profilePaths.append(os.path.relpath(os.path.join(parentDirectory, filename), directory))
+        return sorted(profilePaths)
+
+    def _GetProfileFingerprint(self):
+        """A hash of the code files, their flags and the training workload the --pgo profile is from."""
+        fingerprint = hashlib.sha1()
+        label, variant = self._GetVariant("instrumented")
+        fingerprint.update(
+            json.dumps(
+                [
+                    variant,
+                    sorted(self._libraryDependencies),
+                    self._buildName,
+                    self._options.binaryArgs,
+                    self._options.pgoRuns,
+                ]
+            ).encode()
+        )
+        codeFiles = list(self._codeFilesStore.values()) + self._sourceCodeFiles
+        for codeFile in sorted(codeFiles, key=CodeFile.GetFullPath):
+            fingerprint.update(codeFile.GetFullPath().encode() + b"\0")
+            with open(codeFile.GetFullPath(), "rb") as codeFileHandle:
+                fingerprint.update(hashlib.sha1(codeFileHandle.read()).digest())
+        return fingerprint.hexdigest()
+
+    def _GetRawProfileDirectory(self):
+        """Where the instrumented binary writes its profiles when built with clang."""
+        return os.path.join(self._GetBuildDirectory("instrumented"), "profiles")
+
+    def _GetMergedProfilePath(self):
+        """The clang profile merged from all of the training runs."""
+        return os.path.join(self._GetBuildDirectory("instrumented"), "merged.profdata")
+
+    def _GetProfileFlags(self):
+        """The flags for the current --pgo stage, which are passed both when compiling and when linking."""
+        if self._profileStage == "instrumented":
+            if self._options.clang:
+                return "-fprofile-generate=" + shellEscape(os.path.abspath(self._GetRawProfileDirectory()))
+            return "-fprofile-generate"
+        if self._options.clang:
+            return "-fprofile-use=" + shellEscape(self._GetMergedProfilePath())
+        # The profile of a multithreaded training run can be slightly inconsistent, and files it never ran have none
+        return "-fprofile-use -fprofile-correction -Wno-missing-profile"
+
+    def _GetProfilePath(self, objectFileName):
+        """The profile the optimized --pgo build of objectFileName reads, so that it is rebuilt when that changes."""
+        if self._options.clang:
+            return self._GetMergedProfilePath()
+        return fileName(objectFileName) + ".gcda"
+
+    def _Phase(self, name):
+        """Time what is done within `with self._Phase(name):`, with --timings."""
+        if self._timings is None:
+            return contextlib.nullcontext()
+        return self._timings.Phase(name)
+
+    def _GetTimingsLogPath(self):
+        """Where the build file's commands log their timings, see launcher.py."""
+        return os.path.join(self._GetStateDirectory(), "timings.log")
+
+    def _Watch(self):
+        """Stay running, and rebuild (and restart the binary) every time a code file changes."""
+        watcher = FileWatcher(self._GetWatchedDirectories())
+        process = None
+        try:
+            while True:
+                if self._Build():
+                    if self._options.run:
+                        process = self._RestartBinary(process)
+                else:
+                    logger.WarningMessage("Compilation failed. Waiting for changes.")
+
+                while True:
+                    changedPaths = watcher.Wait()
+                    try:
+                        self._UpdateCrawl(changedPaths)
+                        self._WriteBuildFiles(self._GenerateBuildFile())
+                    except SupermakeError as e:
+                        logger.ErrorMessage(e.What())
+                        continue
+                    watcher.SetDirectories(self._GetWatchedDirectories())
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if process is not None:
+                self._StopBinary(process)
+            watcher.Close()
+
+    def _GetWatchedDirectories(self):
+        codeFiles = list(self._codeFilesStore.values()) + self._sourceCodeFiles
+        directories = set(self._crawledDirectories) | set(codeFile.GetDirectory() or "." for codeFile in codeFiles)
+        for codeFile in codeFiles:  # Where #included headers that do not exist yet would appear
+            for missingPath in codeFile.GetMissingIncludePaths():
+                directory = os.path.dirname(missingPath) or "."
+                if os.path.isdir(directory):
+                    directories.add(directory)
+        return directories
+
+    def _PrintCacheStats(self):
+        stats = CompileCache(
+            self._options.compileCacheDirectory or CompileCache.GetDefaultDirectory(), self._options.compileCacheSize
+        ).GetStats()
+        lookups = stats["hits"] + stats["misses"]
+        print("Compile cache: " + (self._options.compileCacheDirectory or CompileCache.GetDefaultDirectory()))
+        print("  Hits:    " + str(stats["hits"]))
+        print("  Misses:  " + str(stats["misses"]))
+        if lookups:
+            print("  Hit rate: {:.1f}%".format(100.0 * stats["hits"] / lookups))
+        print("  Entries: " + str(stats["entries"]))
+        print("  Size:    {:.1f} MB of {:.1f} MB".format(stats["size"] / 1024.0**2, stats["maxSize"] / 1024.0**2))
+
+    def _NameBuild(self):
         self._buildName = self._options.binaryName
         if not self._buildName and not self._options.libraryName:
             self._buildName = self._GuessBuildName()
@@ -467,14 +2438,8 @@ class Supermake:
                 "Guessed a binary name: '" + self._buildName + "' (use --binary=NAME to specify this yourself)"
             )
 
-        # Create the makefile
-        self._makefile = self._GenerateMakefile()
-
-        # Print the makefile
-        if self._options.printMakefile:
-            print(self._makefile)
-            return
-
+    def _WriteMakefile(self):
+        """Write out the generated makefile, backing up the old one if it differs. Returns whether to autoclean."""
         if not self._options.discrete:
             self._makefile = makefileHeader + "\n" + self._makefile  # Add header
 
@@ -489,11 +2454,13 @@ class Supermake:
         if self._oldMakefileName:
             autoCleanNeeded = self._IsAutocleanNeeded()
 
-            oldMakefileFile = open(self._oldMakefileName)
+            oldMakefile = open(self._oldMakefileName).read()
 
-            if oldMakefileFile.read() != self._makefile:
+            if oldMakefile != self._makefile and not self._HasFlagStamps(
+                oldMakefile
+            ):  # Otherwise its build directory has a copy
                 oldMakefileBackupFd, oldMakefileBackupPath = tempfile.mkstemp(
-                    prefix="old_" + self._oldMakefileName + "_", text=True
+                    prefix="old_" + os.path.basename(self._oldMakefileName) + "_", text=True
                 )
                 oldMakefileBackupFile = os.fdopen(oldMakefileBackupFd, "w")
                 logger.WarningMessage(
@@ -501,80 +2468,143 @@ class Supermake:
                     + oldMakefileBackupPath
                     + "' in case you weren't ready for this!)"
                 )
-                oldMakefileBackupFile.write(oldMakefileFile.read())
+                oldMakefileBackupFile.write(oldMakefile)
                 oldMakefileBackupFile.close()
-
-            oldMakefileFile.close()
-        else:
-            for filename in os.listdir("."):
+        elif os.path.isdir(self._GetBuildDirectory()):
+            for filename in os.listdir(self._GetBuildDirectory()):
                 if filename.endswith(".o"):
                     autoCleanNeeded = True
                     break
 
-        # Write out new makefile
+        # Write out new makefile, and keep a copy along with the objects it builds
         makefileFile = open(self._options.prefix + "makefile", "w")
         makefileFile.write(self._makefile)
         makefileFile.close()
 
-        # Autoclean
-        if autoCleanNeeded:
-            if self._oldMakefileName:
-                logger.NoticeMessage("Makefiles critically differ. Cleaning old build files.")
-            else:
-                logger.NoticeMessage("Cleaning old build files.")
-            if self._options.prefix:
-                os.system(make_cmd + " -f " + self._options.prefix + "makefile clean")
-            else:
-                os.system(make_cmd + " clean")
+        os.makedirs(self._GetBuildDirectory(), exist_ok=True)
+        open(os.path.join(self._GetBuildDirectory(), buildDirectoryMarker), "w").close()
+        with open(os.path.join(self._GetBuildDirectory(), self._options.prefix + "makefile"), "w") as makefileFile:
+            makefileFile.write(self._makefile)
 
-        # Compile
-        compilationSuccesful = False
-        if self._options.make:
-            compilationSuccesful = self._Compile()
+        return autoCleanNeeded
 
-        # Run
-        if self._options.run:
-            if not compilationSuccesful:
-                raise SupermakeError("Compilation failed.")
-            self._Run()
+    def _WriteNinjafile(self):
+        """Write out the generated ninja file, and keep a copy along with the objects it builds."""
+        if not self._options.discrete:
+            self._makefile = makefileHeader.replace("makefile", "ninja file", 1) + "\n" + self._makefile
 
-        if not compilationSuccesful:
-            sys.exit(1)
+        for ninjafilePath in [
+            self._GetBuildFileName(),
+            os.path.join(self._GetBuildDirectory(), self._GetBuildFileName()),
+        ]:
+            os.makedirs(os.path.dirname(ninjafilePath) or ".", exist_ok=True)
+            with open(ninjafilePath, "w") as ninjafileFile:
+                ninjafileFile.write(self._makefile)
+        open(os.path.join(self._GetBuildDirectory(), buildDirectoryMarker), "w").close()
+
+    def _Autoclean(self):
+        if self._oldMakefileName:
+            logger.NoticeMessage("Makefiles critically differ. Cleaning old build files.")
+        else:
+            logger.NoticeMessage("Cleaning old build files.")
+        subprocess.call(self._GetBuildCommand("clean"))
 
     def _Crawl(self):
         """Crawl, picking up all code files to generate a representation of all the code files and their dependencies."""
         self._sourceCodeFiles = (
             []
         )  # actual source files, .cpp, .c, etc. Supermake makes a distinction between 'header' files and 'source' files.
-        self._libraryDependencies = set([])
-        codeFilesStore = CodeFilesStore()  # Should only be headers
+        defines = self._GetPreprocessorDefines()
+        self._scanCache = None
+        if self._options.scanCache:
+            self._scanCache = ScanCache(os.path.join(self._GetStateDirectory(), "scancache.json"), defines)
+            self._scanCache.Load()
+        self._codeFilesStore = CodeFilesStore(self._scanCache, defines)  # Should only be headers
+
+        sourceFilepaths = self._FindSourceFilepaths()
+
+        if self._options.scanJobs > 1:
+            self._codeFilesStore.PrescanAll(sourceFilepaths, self._options.scanJobs)
+
+        for filepath in sourceFilepaths:
+            try:
+                self._sourceCodeFiles.append(CodeFile(filepath, self._codeFilesStore))
+            except NotCodeError:
+                pass
+
+        self._SolveCrawl()
+
+    def _UpdateCrawl(self, changedPaths):
+        """Bring the crawl up to date after changedPaths changed, scanning only what they affect again."""
+        changedPaths = set(changedPaths)
+        includers = set([])
+        for codeFile in list(self._codeFilesStore.values()) + self._sourceCodeFiles:
+            for missingPath in codeFile.GetMissingIncludePaths():
+                while missingPath and missingPath not in changedPaths:  # The path itself, or a directory on it
+                    missingPath = os.path.dirname(missingPath)
+                if missingPath:
+                    includers.add(codeFile.GetFullPath())
+                    break
+        changedPaths.update(includers)
+
+        self._codeFilesStore.Forget(changedPaths)
+        unchangedSourceCodeFiles = {
+            sourceCodeFile.GetFullPath(): sourceCodeFile
+            for sourceCodeFile in self._sourceCodeFiles
+            if sourceCodeFile.GetFullPath() not in changedPaths
+        }
+        self._sourceCodeFiles = []
+        for filepath in self._FindSourceFilepaths():
+            sourceCodeFile = unchangedSourceCodeFiles.get(os.path.normpath(os.path.relpath(filepath)))
+            if sourceCodeFile is None:
+                try:
+                    sourceCodeFile = CodeFile(filepath, self._codeFilesStore)
+                except (NotCodeError, OSError):  # OSError: Already gone again
+                    continue
+            self._sourceCodeFiles.append(sourceCodeFile)
+
+        self._SolveCrawl()
 
+    def _FindSourceFilepaths(self):
+        """List the source files to build, and remember which directories they were looked for in."""
         sourceHierarchy = []
         if self._options.recurse:
-            sourceHierarchy = [(directory, filenames) for (directory, unused, filenames) in os.walk(self._options.src)]
+            sourceHierarchy = []
+            for directory, subdirectories, filenames in os.walk(self._options.src):
+                subdirectories[:] = [
+                    subdirectory
+                    for subdirectory in subdirectories
+                    if subdirectory != stateDirectoryName
+                    and not os.path.exists(os.path.join(directory, subdirectory, buildDirectoryMarker))
+                ]  # Nothing of ours to crawl in there
+                sourceHierarchy.append((directory, filenames))
         else:
             sourceHierarchy = [(self._options.src, os.listdir(self._options.src))]
 
-        for directory, filenames in sourceHierarchy:
-            for filepath in [
-                os.path.join(directory, filename)
-                for filename in filenames
-                if fileExtension(filename) in all_source_extensions
-            ]:
-                try:
-                    self._sourceCodeFiles.append(CodeFile(filepath, codeFilesStore))
-                except NotCodeError:
-                    pass
+        self._crawledDirectories = [directory for (directory, filenames) in sourceHierarchy]
+        return [
+            os.path.join(directory, filename)
+            for (directory, filenames) in sourceHierarchy
+            for filename in filenames
+            if fileExtension(filename) in all_source_extensions
+        ]
+
+    def _SolveCrawl(self):
+        """Link the crawled source files up with everything they include, and work out libraries and language."""
+        self._includeGraph = IncludeGraph(self._sourceCodeFiles, self._codeFilesStore)
 
         if not self._sourceCodeFiles:
             raise SupermakeError("No sourcecode found. For help, see --help.")
 
-        libraryDependencies = set([])
+        if self._scanCache is not None:
+            self._scanCache.Save()
+
+        self._libraryDependencies = set([])
         for codeFile in self._sourceCodeFiles:
             self._libraryDependencies.update(codeFile.GetLibraryDependencies())
 
         self._language = "c"
-        if "c++" in [sourceCodeFile.GetLanguage() for sourceCodeFile in codeFilesStore] or "c++" in [
+        if "c++" in [sourceCodeFile.GetLanguage() for sourceCodeFile in self._codeFilesStore.values()] or "c++" in [
             sourceCodeFile.GetLanguage() for sourceCodeFile in self._sourceCodeFiles
         ]:
             self._language = "c++"
@@ -582,6 +2612,73 @@ class Supermake:
         if self._options.overrideLibraryDependencies:
             self._libraryDependencies = set([])
 
+    def _GetManifestPaths(self):
+        """The files and directories the makefile was derived from, for the BuildManifest.
+
+        >>> directory, cwd = tempfile.mkdtemp(), os.getcwd()
+        >>> os.chdir(directory)
+        >>> os.makedirs(os.path.join("include", "sub"))
+        >>> with open("main.c", "w") as source:
+        ...     _ = source.write('#include "sub/x.h"\\nint main(void) { return 0; }\\n')
+        >>> supermake = Supermake(["--binary=main"], run=False)
+        >>> supermake._Crawl()
+        >>> supermake._NameBuild()
+        >>> _ = supermake._GenerateBuildFile()
+        >>> manifest = BuildManifest("manifest.json", ["--binary=main"])
+        >>> _, generatedFiles, directories = supermake._GetManifestPaths()
+        >>> manifest.Save("main", [], generatedFiles, directories)
+        >>> manifest.IsUpToDate()
+        True
+        >>> open(os.path.join("include", "sub", "x.h"), "w").close()  # Where "sub/x.h" was looked for in vain
+        >>> manifest.IsUpToDate()
+        False
+        >>> os.chdir(cwd)
+        >>> shutil.rmtree(directory)
+        """
+        codeFiles = list(self._codeFilesStore.values()) + self._sourceCodeFiles
+        files = [codeFile.GetFullPath() for codeFile in codeFiles]
+        files.append(os.path.abspath(__file__))
+        files.extend(self._flagCacheInputs)
+        generatedFiles = [
+            self._GetBuildFileName(),
+            os.path.join(self._GetBuildDirectory(), self._GetBuildFileName()),
+        ] + list(self._flagStamps)
+        if self._precompiledHeaderIncludes:
+            generatedFiles.append(self._GetPrecompiledHeaderPath())
+        generatedFiles.extend(sorted(self._unityFiles))
+        directories = list(self._crawledDirectories)
+        directories.extend(codeFile.GetDirectory() or "." for codeFile in codeFiles)
+        for codeFile in codeFiles:  # Even those that do not exist yet
+            directories.extend(os.path.dirname(missingPath) or "." for missingPath in codeFile.GetMissingIncludePaths())
+        for directory in ["include", "lib", "bin"]:
+            directories.extend([directory, os.path.join("..", directory)])
+        return files, generatedFiles, directories
+
+    def _GetPreprocessorDefines(self):
+        """The macros known to be defined (or undefined, as None) when compiling, to skip disabled #includes."""
+        defines = dict(platformDefines)
+        if self._options.debug:
+            defines["DEBUG"] = "1"
+        customCFlags = self._options.customCFlags.split()
+        for i, flag in enumerate(customCFlags):
+            if flag in ("-D", "-U") and i + 1 < len(customCFlags):
+                flag += customCFlags[i + 1]
+            if flag.startswith("-D") and len(flag) > 2:
+                name, equals, value = flag[2:].partition("=")
+                defines[name] = value if equals else "1"
+            elif flag.startswith("-U") and len(flag) > 2:
+                defines[flag[2:]] = None
+        return defines
+
+    def _GetStateDirectory(self):
+        """Return the directory Supermake keeps its caches in, creating it if necessary."""
+        stateDirectory = self._options.prefix + stateDirectoryName
+        if not os.path.isdir(stateDirectory):
+            os.makedirs(stateDirectory)
+            with open(os.path.join(stateDirectory, ".gitignore"), "w") as gitignoreFile:
+                gitignoreFile.write("*\n")
+        return stateDirectory
+
     def _GuessBuildName(self):
         """Guess what the project is called based off of heuristics involving surrounding files and directory names."""
         binaryName = ""
@@ -627,6 +2724,59 @@ class Supermake:
 
         return binaryName + executable_extension
 
+    def _GetVariant(self, profileStage=None):
+        """A label and the options that tell one build directory from another, for profileStage if given."""
+        variant = {
+            "debug": self._options.debug,
+            "warn": self._options.warn,
+            "optimize": self._options.optimize,
+            "clang": self._options.clang,
+            "custom": self._GetCustomCompileFlags(),
+        }
+        # Only when in use, so that the other build directories keep their names
+        if self._options.lto:
+            variant["lto"] = self._options.lto
+        if self._options.profiler:
+            variant["profiler"] = self._options.profiler
+        profileStage = profileStage or self._profileStage
+        if profileStage:
+            variant["pgo"] = profileStage
+        labelParts = [name for name in ["debug", "optimize", "lto", "pgo"] if variant.get(name)]
+        if profileStage == "instrumented":
+            labelParts.append("instrumented")
+        if self._options.profiler:
+            labelParts.append(self._options.profiler)
+        label = "-".join(labelParts) or "default"
+        return label, variant
+
+    def _GetCustomCompileFlags(self):
+        """The --custom flags that affect compiling, leaving out those only passed to the linker."""
+        customFlags = splitFlags(self._options.customCFlags)
+        return " ".join(flags for flags in [customFlags["CPPFLAGS"], customFlags["CFLAGS"]] if flags)
+
+    def _GetBuildDirectory(self, profileStage=None):
+        if self._options.buildDirectory:
+            if (profileStage or self._profileStage) == "instrumented":
+                return os.path.join(os.path.normpath(self._options.buildDirectory), "instrumented")
+            return os.path.normpath(self._options.buildDirectory)
+        return self._GetVariantDirectory(*self._GetVariant(profileStage))
+
+    @staticmethod
+    def _GetVariantDirectory(label, variant):
+        """The build directory of a variant from _GetVariant(), named after its label and options' hash.
+
+        >>> variant = {"debug": False, "optimize": True, "custom": ""}
+        >>> Supermake._GetVariantDirectory("optimize", variant)
+        'build/optimize-6cdd1374'
+        >>> Supermake._GetVariantDirectory("optimize", dict(reversed(variant.items())))
+        'build/optimize-6cdd1374'
+        >>> Supermake._GetVariantDirectory("optimize", dict(variant, custom="-march=native"))
+        'build/optimize-33eff8aa'
+        """
+        return os.path.join(
+            "build", label + "-" + hashlib.sha1(json.dumps(variant, sort_keys=True).encode()).hexdigest()[:8]
+        )
+
     def _GetObjectFileName(self, sourceCodeFile):
         pathDistinguisher = sourceCodeFile.GetDirectory()
         if self._options.src != ".":
@@ -635,21 +2785,12 @@ class Supermake:
             pathDistinguisher = ""
         else:
             pathDistinguisher = pathDistinguisher + "-"
-        return self._options.prefix + pathDistinguisher + sourceCodeFile.GetName() + ".o"
-
-    def _GenerateMakefile(self):
-        """From some abstract options, generate the actual text of a gnu makefile."""  # Not sure removing this from its own unique class was a good idea. Flow of information now isn't explicit.
-
-        makefile = ""
-        makefile += "OBJS = "
-
-        makefile += " ".join(
-            shellEscape(self._GetObjectFileName(sourceCodeFile))
-            for sourceCodeFile in sorted(self._sourceCodeFiles, key=CodeFile.GetFullPath)
+        return os.path.join(
+            self._GetBuildDirectory(), self._options.prefix + pathDistinguisher + sourceCodeFile.GetName() + ".o"
         )
 
-        makefile += "\n"
-
+    def _DescribeBuild(self):
+        """Work out the compiler, the flags and the compile units that the build file is generated from."""
         CFlags = ""
         if os.name == "posix":
             CFlags += " -L/usr/local/include"
@@ -678,16 +2819,22 @@ class Supermake:
             )
             # Add the libraries in there. #This doesn't really belong here in GenerateMakefile, none of these include directory/lib directory related things do but it is the best simple solution I've thought of. Not gonig to go back and reinvent the entire library system when the only use here is a small special case.
             for library in sorted(os.listdir(additionalLibrarySearchPath)):
-                m = re.match(r"lib([^\.]+)\.(?:so|a)", library)
+                m = libraryFilePattern.match(library)
                 if m:
                     self._libraryDependencies.add(
                         "-l" + m.group(1)
                     )  # Should not be adding to self._libraryDependencies because GenerateMakefile shouldn't modify state (it is jsut taking the already defined abstract makefile and converting it into what gmake reads). See above for the root problem.
 
-        CFlags += " " + " ".join(sorted(self._libraryDependencies))
+        # Expand `pkg-config ...` and the like now, rather than in the shell for every compile
+        if self._flagCache is None:  # Kept for the whole run, see FlagCache
+            self._flagCache = FlagCache(os.path.join(self._GetStateDirectory(), "flagcache.json"))
+            self._flagCache.Load()
+        CFlags += " " + " ".join(self._flagCache.Expand(flag) for flag in sorted(self._libraryDependencies))
+        self._flagCache.Save()
+        self._flagCacheInputs = self._flagCache.GetInputs()
 
         if self._options.debug:
-            CFlags += " -g -DDEBUG"  # -pg'# -lprofiler' #You'll have to use `--custom`
+            CFlags += " -g -DDEBUG"  # For profiling (-pg, -lprofiler), see --profile
 
         if self._options.warn:
             CFlags += " -Wall"
@@ -695,15 +2842,295 @@ class Supermake:
         if self._options.optimize:
             CFlags += " -O3"
 
+        if self._options.lto:
+            CFlags += " " + self._GetLinkTimeOptimizationFlags()
+
+        if self._profileStage:
+            CFlags += " " + self._GetProfileFlags()
+
+        if self._options.profiler:
+            CFlags += " " + " ".join(profilerFlags[self._options.profiler])
+
+        linker = self._ChooseLinker()
+        if linker:
+            additionalLibrarySearchPaths += " -fuse-ld=" + linker
+
         if self._options.customCFlags:
             CFlags += " " + self._options.customCFlags
 
-        makefile += "FLAGS =" + CFlags + "\n\n"
+        # Kept apart so that a change to only the link flags relinks rather than recompiling everything
+        self._flags = splitFlags(CFlags + additionalLibrarySearchPaths)
 
         if self._options.clang:
-            compiler = "clang"
+            self._compiler = "clang"
         else:
-            compiler = {"c++": "g++", "c": "gcc"}[self._language]
+            self._compiler = {"c++": "g++", "c": "gcc"}[self._language]
+        self._archiver = self._ChooseArchiver()
+
+        self._precompiledHeaderIncludes = []
+        precompiledSourceCodeFiles = set([])
+        if self._options.precompiledHeaderFraction is not None:
+            self._precompiledHeaderIncludes, precompiledSourceCodeFiles = self._ChoosePrecompiledHeaderIncludes()
+
+        self._compileUnits = []
+        self._unityFiles = {}  # path -> content
+        for batch in self._BatchSourceCodeFiles():
+            if len(batch) == 1:
+                objectFileName = self._GetObjectFileName(batch[0])
+                sourcePath = batch[0].GetFullPath()
+                dependencyPaths = []
+            else:
+                sourcePath = self._GetUnityFileName(batch)
+                objectFileName = fileName(sourcePath) + ".o"
+                dependencyPaths = [sourceCodeFile.GetFullPath() for sourceCodeFile in batch]
+                self._unityFiles[sourcePath] = "".join(
+                    '#include "' + os.path.relpath(sourceCodeFile.GetFullPath(), os.path.dirname(sourcePath)) + '"\n'
+                    for sourceCodeFile in batch
+                )
+            if not self._options.depfiles:  # Otherwise left to the compiler's depfiles
+                codeFiles = set([])
+                for sourceCodeFile in batch:
+                    codeFiles.update(sourceCodeFile.GetCodeFileDependencies())
+                dependencyPaths.extend(
+                    codeFile.GetFullPath() for codeFile in sorted(codeFiles, key=CodeFile.GetFullPath)
+                )
+            if self._profileStage == "optimized" and os.path.exists(self._GetProfilePath(objectFileName)):
+                dependencyPaths.append(self._GetProfilePath(objectFileName))
+            flags = ""
+            if precompiledSourceCodeFiles.issuperset(batch):
+                dependencyPaths.append(self._GetPrecompiledHeaderOutputPath())
+                if self._options.clang:
+                    flags = " -include-pch " + shellEscape(self._GetPrecompiledHeaderOutputPath())
+                else:  # gcc picks up the .gch next to the header by itself
+                    flags = " -include " + shellEscape(self._GetPrecompiledHeaderPath())
+            self._compileUnits.append(CompileUnit(objectFileName, sourcePath, dependencyPaths, flags))
+
+    def _GetLinkTimeOptimizationFlags(self):
+        """The flags for --lto, which are passed both when compiling and when linking."""
+        if self._options.clang:
+            return {"full": "-flto=full", "thin": "-flto=thin"}[self._options.lto]
+        # gcc has no thin LTO, its nearest is splitting the program into partitions optimized in parallel (the default)
+        return {"full": "-flto=auto -flto-partition=one", "thin": "-flto=auto"}[self._options.lto]
+
+    def _ChooseLinker(self):
+        """The -fuse-ld name of the --linker to link with, or "" for the compiler's default."""
+        if not self._options.linker and self._options.clang and self._options.lto:  # Needs a linker that can load LLVM
+            for linker in ["lld", "gold"]:
+                if shutil.which(linkers[linker]):
+                    return linker
+            logger.WarningMessage(
+                "--lto with --clang needs lld or gold to link, and neither is installed. Linking with the default"
+                " linker instead, which may not understand the LTO objects."
+            )
+            return ""
+        if not self._options.linker:
+            return ""
+        if self._options.linker == "auto":
+            for linker, executable in linkers.items():
+                if shutil.which(executable):
+                    return linker
+            return ""
+        if not shutil.which(linkers[self._options.linker]):
+            logger.WarningMessage(
+                "--linker="
+                + self._options.linker
+                + " requested but '"
+                + linkers[self._options.linker]
+                + "' is not installed, linking with the default linker instead."
+            )
+            return ""
+        return self._options.linker
+
+    def _ChooseArchiver(self):
+        """The ar to create static libraries with. With --lto, one that can index LTO objects."""
+        if not self._options.lto:
+            return "ar"
+        archiver = "llvm-ar" if self._options.clang else self._compiler.replace("g++", "gcc") + "-ar"
+        if not shutil.which(archiver):
+            logger.WarningMessage(
+                "'"
+                + archiver
+                + "' is not installed, so the static library's LTO objects may not link. Archiving with 'ar' instead."
+            )
+            return "ar"
+        return archiver
+
+    def _BatchSourceCodeFiles(self):
+        """Split the source files into batches compiled as one object each, cut by path hash with --unity.
+
+        >>> directory, cwd = tempfile.mkdtemp(), os.getcwd()
+        >>> os.chdir(directory)
+        >>> for name in ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j"]:
+        ...     open(name + ".c", "w").close()
+        >>> def batchNames():
+        ...     supermake = Supermake(["--unity=3", "--binary=x"], run=False)
+        ...     supermake._Crawl()
+        ...     return [[codeFile.GetFullPath() for codeFile in batch] for batch in supermake._BatchSourceCodeFiles()]
+        >>> before = batchNames()
+        >>> before
+        [['a.c', 'b.c', 'c.c'], ['d.c', 'e.c'], ['f.c', 'g.c', 'h.c', 'i.c', 'j.c']]
+        >>> open("c2.c", "w").close()  # Only the batch a file joins or leaves changes
+        >>> after = batchNames()
+        >>> [batch for batch in before if batch not in after], [batch for batch in after if batch not in before]
+        ([['d.c', 'e.c']], [['c2.c', 'd.c', 'e.c']])
+        >>> os.remove("c2.c")
+        >>> os.remove("g.c")
+        >>> after = batchNames()
+        >>> [batch for batch in before if batch not in after], [batch for batch in after if batch not in before]
+        ([['f.c', 'g.c', 'h.c', 'i.c', 'j.c']], [['f.c', 'h.c', 'i.c', 'j.c']])
+        >>> os.chdir(cwd)
+        >>> shutil.rmtree(directory)
+        """
+        sourceCodeFiles = sorted(self._sourceCodeFiles, key=CodeFile.GetFullPath)
+        if not self._options.unityBatchSize:
+            return [[sourceCodeFile] for sourceCodeFile in sourceCodeFiles]
+
+        batches = []
+        openBatches = {}  # (directory, language) -> the batch being filled
+        for sourceCodeFile in sourceCodeFiles:
+            if any(
+                fnmatch.fnmatch(sourceCodeFile.GetFullPath(), pattern) for pattern in self._options.unityExcludePatterns
+            ):
+                batches.append([sourceCodeFile])
+                continue
+            group = (sourceCodeFile.GetDirectory(), sourceCodeFile.GetLanguage())
+            if group not in openBatches:
+                openBatches[group] = []
+                batches.append(openBatches[group])
+            batch = openBatches[group]
+            batch.append(sourceCodeFile)
+            boundary = int(hashlib.sha1(sourceCodeFile.GetFullPath().encode()).hexdigest(), 16)
+            if boundary % self._options.unityBatchSize == 0:
+                del openBatches[group]
+        return batches
+
+    def _GetUnityFileName(self, batch):
+        """Where the generated source file #including every file of batch goes, named after the first of them."""
+        sourceCodeFile = batch[0]
+        objectFileName = self._GetObjectFileName(sourceCodeFile)
+        extension = {"c++": "cpp", "c": "c"}[sourceCodeFile.GetLanguage()]
+        return os.path.join(
+            os.path.dirname(objectFileName), "unity-" + fileName(os.path.basename(objectFileName)) + "." + extension
+        )
+
+    def _WriteUnityFiles(self):
+        """Write out the generated unity source files whose contents changed."""
+        for unityFilePath, content in sorted(self._unityFiles.items()):
+            try:
+                with open(unityFilePath) as unityFile:
+                    if unityFile.read() == content:
+                        continue
+            except OSError:
+                os.makedirs(os.path.dirname(unityFilePath), exist_ok=True)
+            with open(unityFilePath, "w") as unityFile:
+                unityFile.write(content)
+
+    def _ChoosePrecompiledHeaderIncludes(self):
+        """Pick the <system> headers for --pch, and the source files that can safely get them."""
+        systemIncludes = {}
+        for sourceCodeFile in self._sourceCodeFiles:
+            # The precompiled header comes first, so e.g. a #define _GNU_SOURCE before the #includes would be too late
+            if sourceCodeFile.GetLanguage() != self._language or sourceCodeFile.HasDirectiveBeforeInclude():
+                continue
+            includes = set(sourceCodeFile.GetSystemIncludes())
+            for codeFile in sourceCodeFile.GetCodeFileDependencies():
+                includes.update(codeFile.GetSystemIncludes())
+            systemIncludes[sourceCodeFile] = includes
+
+        counts = {}
+        for includes in systemIncludes.values():
+            for header in includes:
+                counts[header] = counts.get(header, 0) + 1
+        threshold = max(2, self._options.precompiledHeaderFraction * len(systemIncludes))
+        headers = sorted(header for header, count in counts.items() if count >= threshold)
+        sourceCodeFiles = set(
+            sourceCodeFile
+            for sourceCodeFile, includes in systemIncludes.items()
+            if includes.issuperset(headers) and not set(sourceCodeFile.GetSystemIncludesAfterLocal()) & set(headers)
+        )
+        if not headers or len(sourceCodeFiles) < 2:
+            return [], set([])
+        return headers, sourceCodeFiles
+
+    def _GetLauncher(self, category, target):
+        """What category's commands are run through for --compile-cache and --timings. target is their output."""
+        wrapperArguments = []
+        # Not for the optimized --pgo build, the cache's keys do not cover the profile
+        if category == "compile" and self._options.compileCacheDirectory and self._profileStage != "optimized":
+            wrapperArguments.append("--cache-exec=" + shellEscape(os.path.abspath(self._options.compileCacheDirectory)))
+        if self._options.timingsPath:
+            wrapperArguments.extend(
+                [
+                    "--time-exec=" + shellEscape(os.path.abspath(self._GetTimingsLogPath())),
+                    "--time-category=" + category,
+                    "--time-name=" + target,
+                ]
+            )
+        if not wrapperArguments:
+            return ""
+        return (  # Not this module, which takes much longer to start. -S skips the site module, which it has no use for
+            shellEscape(sys.executable) + " -S " + shellEscape(launcherPath) + " " + " ".join(wrapperArguments) + " -- "
+        )
+
+    def _GetPrecompiledHeaderPath(self):
+        return os.path.join(self._GetBuildDirectory(), self._options.prefix + "supermake-pch.h")
+
+    def _GetPrecompiledHeaderOutputPath(self):
+        return self._GetPrecompiledHeaderPath() + (".pch" if self._options.clang else ".gch")
+
+    def _GetPrecompiledHeaderCommand(self, flags, headerPath, outputPath):
+        """The command that precompiles the (already escaped) headerPath into outputPath with flags."""
+        return self._compiler + " " + flags + " -x " + self._language + "-header " + headerPath + " -o " + outputPath
+
+    def _WritePrecompiledHeader(self):
+        """Write out the header to be precompiled, if it changed, so that it is only recompiled when it has to be."""
+        if not self._precompiledHeaderIncludes:
+            return
+        content = "".join("#include <" + header + ">\n" for header in self._precompiledHeaderIncludes)
+        try:
+            with open(self._GetPrecompiledHeaderPath()) as headerFile:
+                if headerFile.read() == content:
+                    return
+        except OSError:
+            os.makedirs(self._GetBuildDirectory(), exist_ok=True)
+        with open(self._GetPrecompiledHeaderPath(), "w") as headerFile:
+            headerFile.write(content)
+
+    def _GenerateMakefile(self):
+        """From some abstract options, generate the actual text of a gnu makefile."""  # Not sure removing this from its own unique class was a good idea. Flow of information now isn't explicit.
+
+        # $@ is the target's name unescaped, so quote it for the shell (gmake only minds quotes outside of recipes)
+        quotedTarget = "'$(subst ','\\'',$@)'"
+
+        makefile = ""
+        makefile += "OBJS = "
+
+        objects = " ".join(shellEscape(compileUnit.GetObjectFileName()) for compileUnit in self._compileUnits)
+        makefile += objects
+
+        makefile += "\n"
+
+        for variable in ["CPPFLAGS", "CFLAGS", "LDFLAGS", "LDLIBS"]:
+            makefile += variable + " =" + (" " if self._flags[variable] else "") + self._flags[variable] + "\n"
+        makefile += "\n"
+
+        # Every rule also depends on a stamp file holding its exact command, which is only rewritten when that command
+        # changes (see _WriteFlagStamps), so changing flags rebuilds exactly what was built with different flags.
+        # The objects' stamps live in the build directory along with the objects, the others are shared by all of them.
+        self._flagStamps = {}
+        for stampDirectory in [self._options.prefix + stateDirectoryName, self._GetBuildDirectory()]:
+            makefile += shellEscape(os.path.join(stampDirectory, "flags")) + "/%.flags: ;\n"  # In case one goes missing
+        makefile += "\n"
+        compileFlags = "$(CPPFLAGS) $(CFLAGS)"
+        linkFlags = "$(CFLAGS) $(LDFLAGS)"
+
+        def expandFlags(command):
+            """command with its flag variables substituted, for its flag stamp."""
+            for variable, flags in self._flags.items():
+                command = command.replace("$(" + variable + ")", flags)
+            return " ".join(command.split())
+
+        compiler = self._compiler
 
         if self._options.libraryName:
             makefile += (
@@ -714,56 +3141,102 @@ class Supermake:
                 + ".so\n\n"
             )
             # static library
-            makefile += shellEscape(self._options.libraryName) + ".a: $(OBJS)\n"
-            makefile += "\tar rcs " + shellEscape(self._options.libraryName) + ".a $(OBJS)\n\n"
+            archiveCommand = self._archiver + " rcs " + shellEscape(self._options.libraryName) + ".a $(OBJS)"
+            makefile += (
+                shellEscape(self._options.libraryName)
+                + ".a: $(OBJS) "
+                + self._AddFlagStamp("archive", archiveCommand.replace("$(OBJS)", objects))
+                + "\n"
+            )
+            makefile += "\t" + self._GetLauncher("link", quotedTarget) + archiveCommand + "\n\n"
 
             # shared library
-            makefile += shellEscape(self._options.libraryName) + ".so: $(OBJS)\n"
-            makefile += (
-                "\t"
-                + compiler
+            sharedCommand = (
+                compiler
+                + " "
+                + linkFlags
                 + " -shared -Wl,-soname,"
                 + shellEscape(os.path.basename(self._options.libraryName))
-                + ".so $(OBJS) -o "
+                + ".so $(OBJS) $(LDLIBS) -o "
                 + shellEscape(self._options.libraryName)
-                + ".so\n\n"
+                + ".so"
             )
+            makefile += (
+                shellEscape(self._options.libraryName)
+                + ".so: $(OBJS) "
+                + self._AddFlagStamp("shared", expandFlags(sharedCommand.replace("$(OBJS)", objects)))
+                + "\n"
+            )
+            makefile += "\t" + self._GetLauncher("link", quotedTarget) + sharedCommand + "\n\n"
         else:
-            makefile += shellEscape(self._buildName) + ": $(OBJS)\n"
+            linkCommand = compiler + " " + linkFlags + " $(OBJS) $(LDLIBS) -o " + shellEscape(self._buildName)
             makefile += (
-                "\t"
-                + compiler
-                + " $(OBJS) $(FLAGS)"
-                + additionalLibrarySearchPaths
-                + " -o "
-                + shellEscape(self._buildName)
-                + "\n\n"
+                shellEscape(self._buildName)
+                + ": $(OBJS) "
+                + self._AddFlagStamp("link", expandFlags(linkCommand.replace("$(OBJS)", objects)))
+                + "\n"
             )
+            makefile += "\t" + self._GetLauncher("link", quotedTarget) + linkCommand + "\n\n"
 
-        for sourceCodeFile in sorted(self._sourceCodeFiles, key=CodeFile.GetFullPath):
-            objectFileName = shellEscape(self._GetObjectFileName(sourceCodeFile))
+        for compileUnit in self._compileUnits:
+            objectFileName = shellEscape(compileUnit.GetObjectFileName())
+            compileCommand = (
+                compiler
+                + " "
+                + compileFlags
+                + compileUnit.GetFlags()
+                + (" -MMD -MP" if self._options.depfiles else "")
+                + " -c "
+                + shellEscape(compileUnit.GetSourcePath())
+                + " -o "
+                + objectFileName
+            )
             makefile += (
                 objectFileName
                 + ": "
-                + shellEscape(sourceCodeFile.GetFullPath())
+                + shellEscape(compileUnit.GetSourcePath())
                 + " "
                 + " ".join(
-                    [
-                        shellEscape(codeFile.GetFullPath())
-                        for codeFile in sorted(sourceCodeFile.GetCodeFileDependencies(), key=CodeFile.GetFullPath)
+                    [shellEscape(dependencyPath) for dependencyPath in compileUnit.GetDependencyPaths()]
+                    + [
+                        self._AddFlagStamp(
+                            os.path.basename(compileUnit.GetObjectFileName()),
+                            expandFlags(compileCommand),
+                            self._GetBuildDirectory(),
+                        )
                     ]
                 )
+                + " | "
+                + shellEscape(self._GetBuildDirectory())
                 + "\n"
             )
+            makefile += "\t" + self._GetLauncher("compile", quotedTarget) + compileCommand + "\n\n"
+
+        if self._precompiledHeaderIncludes:
+            precompiledHeaderCommand = self._GetPrecompiledHeaderCommand(
+                compileFlags,
+                shellEscape(self._GetPrecompiledHeaderPath()),
+                shellEscape(self._GetPrecompiledHeaderOutputPath()),
+            )
             makefile += (
-                "\t"
-                + compiler
-                + " $(FLAGS) -c "
-                + shellEscape(sourceCodeFile.GetFullPath())
-                + " -o "
-                + objectFileName
-                + "\n\n"
+                shellEscape(self._GetPrecompiledHeaderOutputPath())
+                + ": "
+                + shellEscape(self._GetPrecompiledHeaderPath())
+                + " "
+                + self._AddFlagStamp(
+                    os.path.basename(self._GetPrecompiledHeaderOutputPath()),
+                    expandFlags(precompiledHeaderCommand),
+                    self._GetBuildDirectory(),
+                )
+                + "\n"
             )
+            makefile += "\t" + self._GetLauncher("compile", quotedTarget) + precompiledHeaderCommand + "\n\n"
+
+        makefile += shellEscape(self._GetBuildDirectory()) + ":\n\t" + makedirectory_cmd + " $@\n\n"
+
+        if self._options.depfiles:
+            # The header prerequisites, as found by the compiler itself the last time each object was built
+            makefile += "-include $(OBJS:.o=.d)\n\n"
 
         makefile += "clean:\n\t" + forcedelete_cmd
         if self._options.libraryName:
@@ -772,39 +3245,311 @@ class Supermake:
                 + shellEscape(self._options.libraryName)
                 + ".a "
                 + shellEscape(self._options.libraryName)
-                + ".so *.o"
+                + ".so $(OBJS)"
             )
         else:
             makefile += " " + shellEscape(self._buildName) + " $(OBJS)"
+        if self._options.depfiles:
+            makefile += " $(OBJS:.o=.d)"
+        if self._precompiledHeaderIncludes:
+            makefile += " " + shellEscape(self._GetPrecompiledHeaderOutputPath())
 
         makefile += "\n"
 
         return makefile
 
+    def _GenerateNinjafile(self):
+        """The ninja equivalent of _GenerateMakefile(), without flag stamps as ninja tracks commands itself."""
+        ninjafile = ""
+        ninjafile += "builddir = " + ninjaEscape(self._GetBuildDirectory()) + "\n"
+        for variable in ["CPPFLAGS", "CFLAGS", "LDFLAGS", "LDLIBS"]:
+            ninjafile += variable.lower() + " =" + (" " if self._flags[variable] else "") + self._flags[variable] + "\n"
+        ninjafile += "\n"
+
+        ninjafile += "rule compile\n"
+        ninjafile += (
+            "  command = "
+            + self._GetLauncher("compile", "$out")
+            + self._compiler
+            + " $cppflags $cflags$unitflags -MD -MF $out.d -c $in -o $out\n"
+        )
+        ninjafile += "  depfile = $out.d\n"
+        ninjafile += "  deps = gcc\n\n"
+
+        if self._precompiledHeaderIncludes:
+            ninjafile += "rule pch\n"
+            ninjafile += (
+                "  command = "
+                + self._GetLauncher("compile", "$out")
+                + self._GetPrecompiledHeaderCommand("$cppflags $cflags", "$in", "$out")
+                + " -MD -MF $out.d\n"
+            )
+            ninjafile += "  depfile = $out.d\n"
+            ninjafile += "  deps = gcc\n\n"
+            ninjafile += (
+                "build "
+                + ninjaEscape(self._GetPrecompiledHeaderOutputPath())
+                + ": pch "
+                + ninjaEscape(self._GetPrecompiledHeaderPath())
+                + "\n\n"
+            )
+
+        objects = " ".join(ninjaEscape(compileUnit.GetObjectFileName()) for compileUnit in self._compileUnits)
+
+        if self._options.libraryName:
+            # static library
+            ninjafile += (
+                "rule archive\n  command = " + self._GetLauncher("link", "$out") + self._archiver + " rcs $out $in\n\n"
+            )
+            ninjafile += "build " + ninjaEscape(self._options.libraryName + ".a") + ": archive " + objects + "\n\n"
+
+            # shared library
+            ninjafile += (
+                "rule shared\n  command = "
+                + self._GetLauncher("link", "$out")
+                + self._compiler
+                + " $cflags $ldflags -shared -Wl,-soname,$soname $in $ldlibs -o $out\n\n"
+            )
+            ninjafile += "build " + ninjaEscape(self._options.libraryName + ".so") + ": shared " + objects + "\n"
+            ninjafile += "  soname = " + shellEscape(os.path.basename(self._options.libraryName)) + ".so\n\n"
+
+            ninjafile += (
+                "default "
+                + ninjaEscape(self._options.libraryName + ".a")
+                + " "
+                + ninjaEscape(self._options.libraryName + ".so")
+                + "\n\n"
+            )
+        else:
+            ninjafile += (
+                "rule link\n  command = "
+                + self._GetLauncher("link", "$out")
+                + self._compiler
+                + " $cflags $ldflags $in $ldlibs -o $out\n\n"
+            )
+            ninjafile += "build " + ninjaEscape(self._buildName) + ": link " + objects + "\n\n"
+            ninjafile += "default " + ninjaEscape(self._buildName) + "\n\n"
+
+        for compileUnit in self._compileUnits:
+            ninjafile += (
+                "build "
+                + ninjaEscape(compileUnit.GetObjectFileName())
+                + ": compile "
+                + ninjaEscape(compileUnit.GetSourcePath())
+            )
+            if compileUnit.GetDependencyPaths():
+                ninjafile += " | " + " ".join(
+                    ninjaEscape(dependencyPath) for dependencyPath in compileUnit.GetDependencyPaths()
+                )
+            ninjafile += "\n"
+            if compileUnit.GetFlags():
+                ninjafile += "  unitflags =" + compileUnit.GetFlags() + "\n"
+        ninjafile += "\n"
+
+        ninjafile += "rule clean\n  command = ninja -f " + shellEscape(self._GetBuildFileName()) + " -t clean\n\n"
+        ninjafile += "build clean: clean\n"
+
+        return ninjafile
+
+    def _AddFlagStamp(self, name, command, directory=None):
+        """Register the flag stamp for a rule running command. Returns its escaped path, for a prerequisite."""
+        stampPath = os.path.join(directory or self._options.prefix + stateDirectoryName, "flags", name + ".flags")
+        self._flagStamps[stampPath] = command + "\n"
+        return shellEscape(stampPath)
+
+    def _WriteFlagStamps(self):
+        """Write out the flag stamps of the generated makefile whose command changed."""
+        for stampPath, command in sorted(self._flagStamps.items()):
+            try:
+                with open(stampPath) as stampFile:
+                    if stampFile.read() == command:
+                        continue
+            except OSError:
+                os.makedirs(os.path.dirname(stampPath), exist_ok=True)
+            with open(stampPath, "w") as stampFile:
+                stampFile.write(command)
+
+    @staticmethod
+    def _HasFlagStamps(makefile):
+        """Whether makefile was generated by a Supermake that used flag stamps."""
+        return os.path.join(stateDirectoryName, "flags") in makefile
+
     def _IsAutocleanNeeded(self):
         """Determine if `make clean` is needed (if the previously compiled object files were not compiled the same as they are set to be compiled now)."""
-        oldMakefile = open(self._oldMakefileName).read()
-        if oldMakefile == self._makefile:
-            needsAutoClean = False
+        with open(self._oldMakefileName) as oldMakefile:
+            return self._IsAutocleanNeededSince(oldMakefile.read(), self._makefile)
+
+    @classmethod
+    def _IsAutocleanNeededSince(cls, oldMakefile, makefile):
+        """Whether objects built by oldMakefile have to be cleaned before building with makefile.
+
+        >>> Supermake._IsAutocleanNeededSince("OBJS = a.o\\nFLAGS = -O3 -lm\\n", "OBJS = a.o\\nFLAGS = -O3 -lm\\n")
+        False
+        >>> Supermake._IsAutocleanNeededSince("FLAGS = -Iinc -O3\\n", "CPPFLAGS = -Iinc\\nCFLAGS = -O3\\n")
+        False
+        >>> Supermake._IsAutocleanNeededSince("FLAGS = -O3\\n", "CPPFLAGS =\\nCFLAGS = -g\\n")
+        True
+        >>> Supermake._IsAutocleanNeededSince("OBJS = a.o\\n", "CFLAGS = -g\\n")
+        True
+
+        Makefiles with flag stamps rebuild whatever was built differently themselves:
+
+        >>> Supermake._IsAutocleanNeededSince("a.o: .supermake/flags/a.o.flags\\nCFLAGS = -O3\\n", "CFLAGS = -g\\n")
+        False
+        """
+        if oldMakefile == makefile:
+            return False
+        elif cls._HasFlagStamps(oldMakefile):
+            # The old makefile already had flag stamps, so make itself will rebuild whatever was built differently.
+            return False
         else:
-            # Simply look to see if $FLAGS differs. Simple, faulty, oh well.
-            m1 = re.search("^FLAGS = .+$", oldMakefile, re.MULTILINE)
+            # Simply look to see if the compile flags differ (older makefiles kept them all in $FLAGS). Simple, faulty,
+            # oh well.
+            compileFlagsPattern = re.compile("^(?:FLAGS|CPPFLAGS|CFLAGS) =(.*)$", re.MULTILINE)
+            m1 = compileFlagsPattern.findall(oldMakefile)
             if not m1:
                 return True
             else:
-                m2 = re.search("^FLAGS = .+$", self._makefile, re.MULTILINE)
-                if m2.group() == m1.group():
+                m2 = compileFlagsPattern.findall(makefile)
+                if " ".join(m2).split() == " ".join(m1).split():
                     return False
                 else:
                     return True
 
-    def _Compile(self):
+    def _GetBuildFileName(self):
+        """The name of the makefile (or ninja file) Supermake generates."""
+        if self._options.generator == "ninja":
+            return self._options.prefix + "build.ninja"
+        return self._options.prefix + "makefile"
+
+    def _GetBuildCommand(self, target=None):
+        """The make (or ninja) command line for building target (or the default one), with the parallelism options."""
+        if self._options.generator == "ninja":
+            cmd = [ninja_cmd, "-f", self._GetBuildFileName()]
+            if self._options.jobs:  # Otherwise ninja picks the job count itself
+                cmd.append("-j" + str(self._options.jobs))
+            if self._options.loadAverage is not None:
+                cmd.append("-l" + str(self._options.loadAverage))
+            if target:
+                cmd.append(target)
+            return cmd
+
         cmd = [make_cmd]
         if self._options.prefix:
-            cmd.extend(["-f", shellEscape(self._options.prefix + "makefile")])
-        return subprocess.call(cmd) == 0
+            cmd.extend(["-f", self._options.prefix + "makefile"])
+
+        jobs = self._options.jobs or availableCpuCount()
+        if jobs > 1:
+            cmd.append("-j" + str(jobs))
+            if self._IsOutputSyncSupported():
+                cmd.append("--output-sync=target")  # Keep each compile's errors together
+        if self._options.loadAverage is not None:
+            cmd.append("--load-average=" + str(self._options.loadAverage))
+
+        if target:
+            cmd.append(target)
+        return cmd
+
+    def _IsOutputSyncSupported(self):
+        """--output-sync needs GNU make 4.0 or newer."""
+        try:
+            version = subprocess.run([make_cmd, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        except OSError:
+            return False
+        m = re.match(rb"GNU Make (\d+)", version)
+        return bool(m) and int(m.group(1)) >= 4
+
+    def _Compile(self):
+        return subprocess.call(self._GetBuildCommand()) == 0
+
+    def _RestartBinary(self, process):
+        """Stop process (the binary started last time, if any) and start the binary again, without waiting for it."""
+        if process is not None:
+            self._StopBinary(process)
+        binaryParentFolder, cmdargs = self._GetRunCommand()
+        if os.name == "posix":
+            cmdargs = ["exec"] + cmdargs  # So that stopping the shell stops the binary
+        return subprocess.Popen(" ".join(cmdargs), shell=True, cwd=binaryParentFolder or None)
+
+    @staticmethod
+    def _StopBinary(process):
+        if process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
 
     def _Run(self):
+        binaryParentFolder, cmdargs = self._GetRunCommand()
+
+        if binaryParentFolder:
+            # subprocess.Popen(cmdargs, cwd=binaryParentFolder) #This doesn't properly pipe stdin to gdb and I don't know how to resolve that, so using os.system for now.
+            os.system("cd " + shellEscape(binaryParentFolder) + " && " + " ".join(cmdargs))
+        else:
+            # subprocess.Popen(cmdargs)
+            os.system(" ".join(cmdargs))
+
+    def _Profile(self):
+        """Run the binary under --profile's profiler, and write its report to BINARY.profile.txt."""
+        binaryPath = os.path.abspath(self._buildName)
+        binaryParentFolder = os.path.dirname(binaryPath)
+        reportPath = binaryPath + ".profile.txt"
+        environment = dict(os.environ)
+        profiler = self._options.profiler
+        if profiler == "perf":
+            dataPath = binaryPath + ".perf.data"
+            runCommand = ["perf", "record", "--call-graph=fp", "-o", dataPath, "--", binaryPath]
+            reportCommand = ["perf", "report", "-i", dataPath, "--stdio", "--no-children", "--sort=symbol"]
+        elif profiler == "gprof":
+            dataPath = os.path.join(
+                binaryParentFolder, "gmon.out"
+            )  # Where the binary writes it, as it is run from there
+            runCommand = [binaryPath]
+            reportCommand = ["gprof", "--brief", "--flat-profile", binaryPath, dataPath]
+        else:
+            dataPath = binaryPath + ".prof"
+            environment["CPUPROFILE"] = dataPath
+            runCommand = [binaryPath]
+            pprof = shutil.which("pprof") or shutil.which("google-pprof") or "pprof"
+            reportCommand = [pprof, "--text", binaryPath, dataPath]
+        for command in [runCommand, reportCommand]:
+            if not shutil.which(command[0]):
+                raise SupermakeError("--profile=" + profiler + " needs '" + command[0] + "', which is not installed.")
+
+        if os.path.exists(dataPath):  # Left by the last run
+            os.remove(dataPath)
+        status = subprocess.call(runCommand + self._options.binaryArgs, cwd=binaryParentFolder, env=environment)
+        if status != 0:
+            logger.WarningMessage("The binary exited with status " + str(status) + ".")
+        if not os.path.exists(dataPath):
+            raise SupermakeError("The binary did not leave a profile ('" + dataPath + "') behind.")
+
+        with open(reportPath, "w") as reportFile:
+            if subprocess.call(reportCommand, cwd=binaryParentFolder, stdout=reportFile) != 0:
+                raise SupermakeError("Unable to make a report of the profile '" + dataPath + "'.")
+        logger.NoticeMessage("Wrote the profile's report to '" + os.path.relpath(reportPath) + "'.")
+
+    def _Benchmark(self):
+        """Run the binary --bench's N times and report the statistics. Raises a SupermakeError on a regression."""
+        (binaryParentFolder, binaryFilename) = os.path.split(self._buildName)
+        argv = [os.path.join(".", binaryFilename)] + self._options.binaryArgs
+        for _ in range(self._options.benchWarmupRuns):
+            Benchmark.Measure(argv, binaryParentFolder or None)
+        samples = [Benchmark.Measure(argv, binaryParentFolder or None) for _ in range(self._options.benchRuns)]
+
+        benchmark = Benchmark(os.path.join(self._GetStateDirectory(), "bench.json"), self._options.benchThreshold)
+        slowdown = benchmark.Record(json.dumps([self._buildName] + self._options.binaryArgs), samples)
+        if slowdown is not None and slowdown > self._options.benchThreshold:
+            raise SupermakeError(
+                f"The binary got {slowdown:.1f}% slower than at the last benchmark that passed"
+                f" (more than --bench-threshold's {self._options.benchThreshold:g}%)."
+            )
+
+    def _GetRunCommand(self):
+        """The directory to run the binary from, and the (shell) command line that runs it."""
         (binaryParentFolder, binaryFilename) = os.path.split(self._buildName)
 
         executeBinaryCmd = binaryFilename
@@ -823,12 +3568,7 @@ class Supermake:
             cmdargs = [executeBinaryCmd]
             cmdargs.extend(self._options.binaryArgs)
 
-        if binaryParentFolder:
-            # subprocess.Popen(cmdargs, cwd=binaryParentFolder) #This doesn't properly pipe stdin to gdb and I don't know how to resolve that, so using os.system for now.
-            os.system("cd " + shellEscape(binaryParentFolder) + " && " + " ".join(cmdargs))
-        else:
-            # subprocess.Popen(cmdargs)
-            os.system(" ".join(cmdargs))
+        return binaryParentFolder, cmdargs
 
 
 def main():